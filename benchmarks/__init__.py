@@ -0,0 +1,4 @@
+"""
+This package contains a synthetic spiking data generator and timed benchmarks
+of the analysis pipeline, for measuring performance without simulation output.
+"""
@@ -0,0 +1,87 @@
+"""
+This file contains a regression check of the numpy PID engine against stored
+outputs of the infotheory library, for a few fixed 3D and 4D arrays.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.pid import decompose_3d, decompose_4d
+
+reference_path = os.path.join(os.path.dirname(__file__), "infotheory_reference.json")
+
+# largest difference allowed, as both engines round to 4 decimals
+tolerance = 1e-4
+
+
+def reference_cases(seed=2024, n_rows=80):
+    """returns the fixed arrays of the check by name: random counts, an XOR
+    target, and constant target and source columns"""
+    rng = np.random.default_rng(seed)
+    cases = {}
+    cases["3d_counts"] = rng.poisson([8, 15, 20], (n_rows, 3))
+    cases["4d_counts"] = rng.poisson([8, 15, 20, 20], (n_rows, 4))
+    sources = rng.integers(0, 2, (n_rows, 2))
+    target = (sources[:, 0] ^ sources[:, 1]) * 10 + rng.poisson(1, n_rows)
+    cases["3d_xor"] = np.column_stack([target, sources * 20])
+    inputs = rng.poisson([15, 20, 20], (n_rows, 3))
+    inputs[:, 2] = 0  # source switched off, as for k = 2 and 3
+    cases["4d_constant_source"] = np.column_stack([rng.poisson(8, n_rows), inputs])
+    inputs = rng.poisson([15, 20], (n_rows, 2))
+    cases["3d_constant_target"] = np.column_stack([np.full(n_rows, 3), inputs])
+    data = rng.poisson([8, 15, 20, 20], (n_rows, 4))
+    data[:, 1] = 7
+    cases["4d_constant_source_1"] = data
+    return cases
+
+
+def decompose(data, engine):
+    """PID terms of a 3D or 4D array with the given engine"""
+    data = np.asarray(data, dtype=float)
+    if data.shape[1] == 3:
+        return decompose_3d(data, engine)
+    return decompose_4d(data, engine)
+
+
+def write_reference(path=reference_path):
+    """stores the arrays of reference_cases with their infotheory PID terms
+    (needs a working infotheory installation)"""
+    reference = {
+        name: {
+            "data": data.tolist(),
+            "terms": [float(x) for x in decompose(data, "infotheory")],
+        }
+        for name, data in reference_cases().items()
+    }
+    with open(path, "w") as f:
+        f.write(
+            "{\n"
+            + ",\n".join(
+                f"{json.dumps(k)}: {json.dumps(v)}" for k, v in reference.items()
+            )
+            + "\n}\n"
+        )  # an array per line
+
+
+def check_engine(path=reference_path):
+    """compares the numpy engine with the stored infotheory terms
+
+    Returns the largest difference for each array, and raises a ValueError if
+    any is above tolerance.
+    """
+    with open(path) as f:
+        reference = json.load(f)
+    rows = []
+    for name, case in reference.items():
+        terms = np.array(decompose(case["data"], "numpy"), dtype=float)
+        rows.append([name, np.max(np.abs(terms - case["terms"]))])
+    table = pd.DataFrame(rows, columns=["array", "max_difference"])
+    failed = table[table["max_difference"] > tolerance]
+    if len(failed):
+        raise ValueError(
+            "Numpy engine does not match infotheory for " + ", ".join(failed["array"])
+        )
+    return table
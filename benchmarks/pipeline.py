@@ -0,0 +1,191 @@
+"""
+This file contains timed benchmarks of the analysis pipeline on synthetic spiking
+data (see synthetic_data.py), reporting time, throughput and peak memory.
+"""
+
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+from unittest import mock
+
+import pandas as pd
+
+from src import instrument, pid, sig_test
+from src.util import combine_data, filter_data, group_index, read_data, shuffle_data
+from benchmarks.synthetic_data import write_synthetic_scheme
+
+benchmarks_dir = "files/benchmarks"
+
+benchmark_cols = ["benchmark", "n_cells", "seconds", "cells_per_second", "peak_mb"]
+
+
+def measure(name, func, n_cells=None, repeats=3):
+    """times func as its best of repeats runs, then runs it once more to record
+    its peak traced memory (which slows it down, so is not timed)
+
+    Returns a row of benchmark_cols; with n_cells, throughput is in cells/s.
+    """
+    seconds = float("inf")
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds = min(seconds, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    cells_per_second = n_cells / seconds if n_cells else float("nan")
+    print(f"{name}: {seconds:.4f} s")
+    return [name, n_cells, seconds, cells_per_second, peak / 2**20]
+
+
+def over_cells(func, cells):
+    """returns a function that calls func on every cell"""
+    return lambda: [func(*cell) for cell in cells]
+
+
+def write_sig_test_inputs(df, condition_dir, index, n_surrogates=2):
+    """writes trials results and surrogates of the phasic epoch for sig_test"""
+    if not os.path.exists(condition_dir):
+        os.makedirs(condition_dir)
+    results = pid.pid_analysis(df, index=index)
+    results.to_feather(os.path.join(condition_dir, "trials_results_phasic"))
+    surrogates = pid.pid_surrogates(df, random_seeds=range(n_surrogates), index=index)
+    surrogates.to_feather(os.path.join(condition_dir, "trials_surrogate_0_phasic"))
+    final = (
+        results.groupby(pid.condition_cols)[pid.pid_value_cols]
+        .agg(["mean", "std"])
+        .reset_index()
+    )
+    final.columns = [
+        "{}_{}".format(col[0], col[1]) if col[1] else col[0] for col in final.columns
+    ]
+    return final
+
+
+def run_benchmarks(
+    n_files=2,
+    n_trials=1000,
+    trials_per_group=500,
+    structure="synergistic",
+    n_surrogates=2,
+    repeats=3,
+    seed=0,
+):
+    """runs every benchmark on a synthetic scheme of n_files files with n_trials
+    rows per condition each, split into trials groups of trials_per_group rows
+
+    Returns a table with a row per benchmark (see benchmark_cols).
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        scheme_dir = os.path.join(tmp_dir, "spiking_data", "Hebbian")
+        filepaths = write_synthetic_scheme(
+            scheme_dir, n_files, n_trials, seed=seed, structure=structure
+        )
+        rows.append(
+            measure("read_data", lambda: read_data(filepaths[0]), None, repeats)
+        )
+        rows.append(
+            measure(
+                "combine_data",
+                lambda: combine_data(filepaths, trials_per_group),
+                None,
+                repeats,
+            )
+        )
+
+        df, index = combine_data(filepaths, trials_per_group, return_index=True)
+        cells = pid.get_cells(df)
+        n_cells = len(cells)
+        bench = [
+            (
+                "filter_data",
+                over_cells(lambda g, k, pw, t: filter_data(df, k, pw, t, g), cells),
+            ),
+            (
+                "filter_data_index",
+                over_cells(
+                    lambda g, k, pw, t: filter_data(df, k, pw, t, g, index), cells
+                ),
+            ),
+            (
+                "pid_3d",
+                over_cells(
+                    lambda g, k, pw, t: pid.pid_3d(
+                        df, g, k, pw, t, "in1_excluded", index=index
+                    ),
+                    cells,
+                ),
+            ),
+            (
+                "pid_4d",
+                over_cells(
+                    lambda g, k, pw, t: pid.pid_4d(df, g, k, pw, t, "4D", index=index),
+                    cells,
+                ),
+            ),
+            ("shuffle_data", lambda: shuffle_data(df, index=index)),
+            ("pid_analysis", lambda: pid.pid_analysis(df, index=index)),
+        ]
+        for name, func in bench:
+            rows.append(measure(name, func, n_cells, repeats))
+
+        # sig_test reads its inputs from the results and surrogates folders, and
+        # generate_p_values is timed without writing its trace
+        final = write_sig_test_inputs(
+            df, os.path.join(tmp_dir, "results", "Hebbian"), index, n_surrogates
+        )
+        with mock.patch.object(
+            sig_test, "results_dir", os.path.join(tmp_dir, "results")
+        ), mock.patch.object(
+            sig_test, "surrogates_dir", os.path.join(tmp_dir, "results")
+        ), mock.patch.object(
+            instrument, "tracing", False
+        ):
+            rows.append(
+                measure(
+                    "generate_p_values",
+                    lambda: sig_test.generate_p_values("Hebbian"),
+                    len(final),
+                    repeats,
+                )
+            )
+        rows.append(
+            measure(
+                "normalise_results",
+                lambda: sig_test.normalise_results(final),
+                len(final),
+                repeats,
+            )
+        )
+    return pd.DataFrame(rows, columns=benchmark_cols)
+
+
+def git_revision():
+    """returns the short hash of the checked out commit, or 'unknown'"""
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return revision.stdout.decode().strip()
+
+
+def save_benchmarks(table, dir=benchmarks_dir):
+    """saves a benchmark table as csv, named by date and git revision, so runs of
+    different versions can be compared"""
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+    filepath = os.path.join(dir, f"benchmarks_{date.today()}_{git_revision()}.csv")
+    table.to_csv(filepath, index=False)
+    return filepath
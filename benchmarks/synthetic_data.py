@@ -0,0 +1,85 @@
+"""
+This file contains functions for writing synthetic spiking data in the layout of
+the simulation output (see util.spiking_data_cols), with known dependence between
+the postsynaptic target and the three pathway sources.
+"""
+
+import os
+import numpy as np
+
+from src.util import spiking_data_cols
+
+# dependence of the target on the sources
+structures = ["independent", "redundant", "synergistic"]
+
+
+def epoch_counts(n_trials, k, structure="synergistic", rng=None):
+    """returns spike counts of one epoch, columns as the phasic (or tonic) ones:
+    postsynaptic, ex/in1/in2 population totals, ex/in1/in2 pathway counts
+
+    independent: the target does not depend on the sources.
+    redundant: the target and all sources share one common drive.
+    synergistic: the target is an XOR of the ex and in1 pathways being above
+    their medians, so neither source alone carries information about it.
+    """
+    if structure not in structures:
+        raise ValueError(
+            "Invalid structure provided: must be 'independent', 'redundant' "
+            "or 'synergistic'"
+        )
+    if rng is None:
+        rng = np.random.default_rng()
+    drive = rng.poisson(15, n_trials)
+    if structure == "redundant":
+        pathways = np.stack([drive + rng.poisson(5, n_trials) for i in range(3)], 1)
+        target = drive + rng.poisson(3, n_trials)
+    else:
+        pathways = rng.poisson(20, (n_trials, 3))
+        target = rng.poisson(10, n_trials)
+    if structure == "synergistic":
+        above = pathways[:, :2] > np.median(pathways[:, :2], axis=0)
+        target = 20 * (above[:, 0] ^ above[:, 1]) + rng.poisson(3, n_trials)
+    if k in [2, 3]:
+        pathways[:, k - 1] = 0  # inhibitory population k - 1 switched off
+    totals = pathways + rng.poisson(40, (n_trials, 3)) * (pathways > 0)
+    return np.column_stack([target, totals, pathways])
+
+
+def synthetic_rows(
+    n_trials,
+    k_conditions=(1, 2, 3),
+    pathways=(1, 9),
+    learning_times=(0, 1, 2, 5),
+    structure="synergistic",
+    rng=None,
+):
+    """returns an array of synthetic spiking data rows, n_trials per condition"""
+    if rng is None:
+        rng = np.random.default_rng()
+    blocks = []
+    for k in k_conditions:
+        for t in learning_times:
+            for pw in pathways:
+                conditions = np.tile([k, t, pw, 10], (n_trials, 1))
+                phasic = epoch_counts(n_trials, k, structure, rng)
+                tonic = epoch_counts(n_trials, k, structure, rng)
+                blocks.append(np.column_stack([conditions, phasic, tonic]))
+    rows = np.concatenate(blocks)
+    return np.column_stack([np.arange(len(rows)), rows])
+
+
+def write_synthetic_scheme(directory, n_files=2, n_trials=1000, seed=0, **kwargs):
+    """writes synthetic .dat files with n_trials rows per condition each, returning
+    their paths (keyword arguments are passed to synthetic_rows)"""
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    rng = np.random.default_rng(seed)
+    filepaths = []
+    for i in range(n_files):
+        rows = synthetic_rows(n_trials, rng=rng, **kwargs)
+        if rows.shape[1] != len(spiking_data_cols):
+            raise ValueError("Synthetic rows do not match spiking_data_cols")
+        filepath = os.path.join(directory, f"spikes_{i}.dat")
+        np.savetxt(filepath, rows, fmt="%g")
+        filepaths.append(filepath)
+    return filepaths
@@ -18,12 +18,18 @@ from src.util import results_dir, figures_dir, spiking_files_dict, phasic_names
 
 #%% generate figures
 
+# surrogate table for the significance tests, e.g. "trials_surrogate_root_0" after
+# a sharded run, if serial surrogates are there too
+surrogate_name = "trials_surrogate"
+
 for phasic in [True, False]:
     for condition in spiking_files_dict.keys():
         df_results = get_feather_data(
             results_dir, condition, "final_results", phasic_names[phasic]
         )
-        df_sig = get_norm_sig(condition=condition, phasic=phasic)
+        df_sig = get_norm_sig(
+            condition=condition, phasic=phasic, surrogate_name=surrogate_name
+        )
         k_values = df_results["k_condition"].unique().tolist()
         pw_values = df_results["pathway"].unique().tolist()
         for k in k_values:  # for all conditions
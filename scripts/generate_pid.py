@@ -17,6 +17,17 @@ from src.util import spiking_files_dict
 
 #%% generate all results
 
-for phasic in [True, False]:
+n_workers = os.cpu_count()  # process pool size for the PID cells
+stream = False  # spill the data to disk, for schemes larger than memory
+mi_null = False  # also save the null data of the analytic MI test (slower)
+
+if __name__ == "__main__":
     for condition in spiking_files_dict.keys():
-        generate_pid_results(condition, phasic=phasic)
+        # phasic and tonic results in one pass over the data
+        generate_pid_results(
+            condition,
+            phasic=None,
+            n_workers=n_workers,
+            stream=stream,
+            mi_null=mi_null,
+        )
@@ -2,8 +2,13 @@
 This script creates surrogate PID values based on shuffled data,
 which is used to test the statistical significance of results.
 Run this script second.
+
+To spread the work over a batch cluster with a shared filesystem, run
+`generate_surrogates.py --shard i --num-shards N` for i = 0, ..., N-1 and then
+`generate_surrogates.py --merge` once all shards have finished.
 """
 
+import argparse
 import os
 import sys
 
@@ -12,15 +17,52 @@ current_dir = os.getcwd()
 os.chdir(current_dir.split(working_dir)[0] + working_dir)
 sys.path.append(os.getcwd())
 
-from src.pid import generate_pid_results
+from src.pid import (
+    generate_pid_results,
+    generate_surrogate_shard,
+    merge_surrogate_run,
+)
 from src.util import spiking_files_dict
 
 #%% generate surrogates
 
-seed = 0
-for phasic in [True, False]:
-    for condition in spiking_files_dict.keys():
-        generate_pid_results(
-            condition, phasic=phasic, surrogate=True, seed=seed, n_surrogates=10
+n_workers = os.cpu_count()  # process pool size for the PID cells
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate surrogate PID values")
+    parser.add_argument("--shard", type=int, help="index of this shard (sharded run)")
+    parser.add_argument("--num-shards", type=int, default=1, help="number of shards")
+    parser.add_argument("--merge", action="store_true", help="merge finished shards")
+    parser.add_argument("--n-surrogates", type=int, default=10)
+    parser.add_argument("--root-seed", type=int, default=0)
+    parser.add_argument("--n-workers", type=int, default=n_workers)
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="stop early for conditions already decided (needs generate_pid results)",
+    )
+    args = parser.parse_args()
+
+    if args.merge:
+        merge_surrogate_run(args.n_surrogates, args.root_seed)
+    elif args.shard is not None:
+        generate_surrogate_shard(
+            args.shard,
+            args.num_shards,
+            args.n_surrogates,
+            args.root_seed,
+            n_workers=args.n_workers,
         )
-        seed += 1
+    else:
+        # phasic seeds are 0, 1, 2 and tonic seeds 3, 4, 5 across the conditions
+        conditions = list(spiking_files_dict.keys())
+        for i, condition in enumerate(conditions):
+            generate_pid_results(
+                condition,
+                phasic=None,
+                surrogate=True,
+                seed={True: i, False: i + len(conditions)},
+                n_surrogates=args.n_surrogates,
+                n_workers=args.n_workers,
+                adaptive=args.adaptive,
+            )
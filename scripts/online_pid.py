@@ -0,0 +1,52 @@
+"""
+This script follows simulations that are still writing spiking data, folding the
+new rows into running joint histograms and printing the PID values as they grow.
+Stop it with Ctrl+C; the state is saved so it can be restarted later.
+"""
+
+import os
+import sys
+import time
+from pathlib import Path
+
+working_dir = "synergy_plasticity_pid"
+current_dir = os.getcwd()
+os.chdir(current_dir.split(working_dir)[0] + working_dir)
+sys.path.append(os.getcwd())
+
+from src.pid import (
+    online_state,
+    fold_new_rows,
+    online_pid,
+    save_online_state,
+    load_online_state,
+)
+from src.util import spiking_data_dir, cache_dir, phasic_names, condition_cols
+
+#%% follow simulation
+
+condition = "Hebbian"
+phasic = True
+poll_seconds = 60  # time between reads of the spiking files
+warm_up = 1000  # rows of a condition from which its bin edges are fixed
+print_cols = condition_cols + ["n_rows", "mi", "r", "sy"]
+
+if __name__ == "__main__":
+    state_path = os.path.join(
+        cache_dir, f"online_{condition}_{phasic_names[phasic]}.pkl"
+    )
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    if os.path.isfile(state_path):
+        state = load_online_state(state_path)
+    else:
+        state = online_state(phasic, warm_up=warm_up)
+    while True:
+        # files are listed again on each poll, as new ones may have been started
+        scheme_dir = Path(spiking_data_dir) / condition
+        filepaths = [file for file in scheme_dir.glob("**/*") if file.is_file()]
+        fold_new_rows(state, filepaths)
+        save_online_state(state, state_path)
+        if state["counts"]:
+            print(online_pid(state)[print_cols])
+        time.sleep(poll_seconds)
@@ -0,0 +1,29 @@
+"""
+This script checks the numpy PID engine against stored infotheory outputs, then
+times the analysis pipeline on synthetic spiking data.
+It saves the results to files/benchmarks, named by date and git revision.
+No simulation data is needed.
+"""
+
+import os
+import sys
+
+working_dir = "synergy_plasticity_pid"
+current_dir = os.getcwd()
+os.chdir(current_dir.split(working_dir)[0] + working_dir)
+sys.path.append(os.getcwd())
+
+from benchmarks.engine_check import check_engine
+from benchmarks.pipeline import run_benchmarks, save_benchmarks
+
+#%% run benchmarks
+
+n_files = 2  # synthetic .dat files
+n_trials = 1000  # rows per condition in each file
+structure = "synergistic"  # 'independent', 'redundant' or 'synergistic'
+
+if __name__ == "__main__":
+    print(check_engine().to_string(index=False))  # raises if the engines differ
+    table = run_benchmarks(n_files, n_trials, structure=structure)
+    print(table.to_string(index=False))
+    print(f"Saved to {save_benchmarks(table)}")
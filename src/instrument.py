@@ -0,0 +1,190 @@
+"""
+This file contains functions for timing the stages of a run, sampling its peak
+memory and reporting its progress, with a JSON-lines trace of each run saved to
+files/traces.
+"""
+
+import functools
+import inspect
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# relative to the working directory, which util sets to the repo (so that util can
+# import this file)
+traces_dir = os.path.join("files", "traces")
+
+# seconds between progress reports
+progress_interval = 10.0
+
+# set to False to run traced functions without traces (e.g. when timing them, as
+# the trace I/O would be timed too); progress is still printed
+tracing = True
+
+# state of the active run (one per process)
+_run = {}
+
+
+def peak_rss_mb():
+    """returns the peak resident set size of this process and of its finished
+    child processes (e.g. pool workers), in MB, or None where unavailable"""
+    if resource is None:
+        return None, None
+    unit = 2**20 if sys.platform == "darwin" else 2**10  # bytes on macOS, else kB
+    return tuple(
+        resource.getrusage(who).ru_maxrss / unit
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+
+def rss_mb():
+    """returns the current resident set size of this process in MB, or None"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def emit(event, **fields):
+    """writes an event with its time and memory to the trace of the active run
+
+    Does nothing without an active run, or in a worker process forked from it.
+    """
+    if not _run or _run["pid"] != os.getpid():
+        return
+    peak, children_peak = peak_rss_mb()
+    record = {
+        "run_id": _run["run_id"],
+        "event": event,
+        "time": round(time.perf_counter() - _run["start"], 6),
+        "rss_mb": rss_mb(),
+        "peak_rss_mb": peak,
+        "children_peak_rss_mb": children_peak,
+    }
+    record.update(fields)
+    _run["file"].write(json.dumps(record, default=str) + "\n")
+    _run["file"].flush()
+
+
+@contextmanager
+def run(name, **fields):
+    """traces a run to files/traces/<name>_<time>_<pid>.jsonl
+
+    Prints the time of each stage when the run ends. Inside an active run, this
+    is a stage of that run instead. Does nothing with tracing off.
+    """
+    if not tracing:
+        yield
+        return
+    if _run:
+        with stage(name, **fields):
+            yield
+        return
+    if not os.path.exists(traces_dir):
+        os.makedirs(traces_dir)
+    run_id = f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid()}"
+    path = os.path.join(traces_dir, run_id + ".jsonl")
+    with open(path, "w") as f:
+        _run.update(
+            run_id=run_id,
+            file=f,
+            pid=os.getpid(),
+            start=time.perf_counter(),
+            stack=[],
+            stages={},
+        )
+        emit("run_start", name=name, **fields)
+        status = "error"
+        try:
+            yield
+            status = "done"
+        finally:
+            seconds = time.perf_counter() - _run["start"]
+            stages = _run["stages"]
+            emit("run_end", status=status, seconds=seconds, stages=stages)
+            _run.clear()
+            print(
+                f"{name} {status} in {seconds:.1f} s ("
+                + ", ".join(f"{key} {secs:.1f} s" for key, secs in stages.items())
+                + f"), trace saved to {path}"
+            )
+
+
+def traced(name):
+    """decorator running each call of a function as a traced run, with its
+    arguments recorded in the run_start event"""
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            with run(name, **bound.arguments):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def stage(name, **fields):
+    """times a stage of the active run, as a path under its enclosing stages
+    (e.g. load/combine), adding up the time of stages with the same path"""
+    if not _run or _run["pid"] != os.getpid():
+        yield
+        return
+    _run["stack"].append(name)
+    path = "/".join(_run["stack"])
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _run["stack"].pop()
+        _run["stages"][path] = _run["stages"].get(path, 0) + seconds
+        emit("stage", stage=path, seconds=seconds, **fields)
+
+
+def progress(total=None, unit="cells", interval=None):
+    """returns a function counting units done, which reports the count (out of
+    total, with the time left at the current rate) every interval seconds
+
+    Reports are printed and written to the trace of the active run.
+    """
+    if interval is None:
+        interval = progress_interval
+    state = {"done": 0, "start": time.perf_counter(), "reported": 0.0}
+
+    def update(n=1):
+        """counts n more units done, reporting if it is time to"""
+        state["done"] += n
+        elapsed = time.perf_counter() - state["start"]
+        finished = total is not None and state["done"] >= total
+        if elapsed - state["reported"] < interval and not finished:
+            return
+        state["reported"] = elapsed
+        message = f"{state['done']}"
+        eta = None
+        if total:
+            eta = elapsed * (total - state["done"]) / state["done"]
+            message += f"/{total} {unit} ({state['done'] / total:.0%})"
+            message += f", {elapsed:.0f} s elapsed, ETA {eta:.0f} s"
+        else:
+            message += f" {unit}, {elapsed:.0f} s elapsed"
+        print(message)
+        emit("progress", unit=unit, done=state["done"], total=total, eta=eta)
+
+    return update
@@ -6,20 +6,42 @@ simulated neuronal data and surrogate data.
 import pandas as pd
 import numpy as np
 import infotheory
+import itertools
+import hashlib
 import os
+import pickle
+from scipy import sparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src import instrument, pid_engine
+from src.sig_test import undecided_groups
 
 from src.util import (
     pid_cols,
     pid_cols_dict,
     spiking_files_dict,
+    schemes,
     condition_cols,
     pid_value_cols,
+    mi_cols,
+    mi_source_axes,
+    trials_group_cols,
+    full_condition_cols,
     results_dir,
+    cache_dir,
     surrogates_dir,
-    combine_data,
-    shuffle_data,
+    files_key,
+    load_combined_data,
+    load_spilled_data,
+    iter_spilled_groups,
+    read_new_rows,
+    surrogate_indices,
+    permute_columns,
     filter_data,
+    group_index,
     phasic_names,
+    shared_array,
+    attach_array,
 )
 
 
@@ -31,19 +53,23 @@ def get_pid_cols(cond, phasic=True):
     return [col + suffix for col in pid_cols_dict[cond]]
 
 
-# Define necessary PID functions using infotheory library
+# Define necessary PID functions using the numpy engine or infotheory library
 
+pid_engines = ["numpy", "infotheory"]
 
-def pid_3d(df, g, k, pw, t, cond, phasic=True):
-    """3-dimensional partial information decomposition (2 inputs, 1 target)"""
-    cols = get_pid_cols(cond, phasic)  # get columns
-    data = filter_data(df, k, pw, t, g)[
-        cols
-    ].to_numpy()  # filter data and convert to numpy
+
+def decompose_3d(data, engine="numpy"):
+    """PID of an array with columns (target, input 1, input 2)"""
+    rnd = lambda x: np.round(x, decimals=4)
+    if engine == "numpy":
+        p = pid_engine.joint_distribution(data)
+        return tuple(rnd(x) for x in pid_engine.pid_3d_terms(p))
     # set up infotheory object
     dims = np.shape(data)[1]
-    it = infotheory.InfoTools(dims, 3)
-    it.set_equal_interval_binning([10] * dims, np.min(data, 0), np.max(data, 0))
+    it = infotheory.InfoTools(dims, pid_engine.n_shifts)
+    it.set_equal_interval_binning(
+        [pid_engine.n_bins] * dims, np.min(data, 0), np.max(data, 0)
+    )
     it.add_data(data)
     # get PID terms
     mi = it.mutual_info([0, 1, 1])
@@ -51,20 +77,21 @@ def pid_3d(df, g, k, pw, t, cond, phasic=True):
     s = it.synergy([0, 1, 2])
     u1 = it.unique_info([0, 1, 2])
     u2 = it.unique_info([0, 2, 1])
-    rnd = lambda x: np.round(x, decimals=4)
     return rnd(mi), rnd(r), rnd(s), rnd(u1), rnd(u2)
 
 
-def pid_4d(df, g, k, pw, t, cond, phasic=True):
-    """4-dimensional partial information decomposition (3 inputs, 1 target)"""
-    cols = get_pid_cols(cond, phasic)  # get columns
-    data = filter_data(df, k, pw, t, g)[
-        cols
-    ].to_numpy()  # filter data and convert to numpy
+def decompose_4d(data, engine="numpy"):
+    """PID of an array with columns (target, input 1, input 2, input 3)"""
+    rnd = lambda x: np.round(x, decimals=4)
+    if engine == "numpy":
+        p = pid_engine.joint_distribution(data)
+        return tuple(rnd(x) for x in pid_engine.pid_4d_terms(p))
     # set up infotheory object
     dims = np.shape(data)[1]
-    it = infotheory.InfoTools(dims, 3)
-    it.set_equal_interval_binning([10] * dims, np.min(data, 0), np.max(data, 0))
+    it = infotheory.InfoTools(dims, pid_engine.n_shifts)
+    it.set_equal_interval_binning(
+        [pid_engine.n_bins] * dims, np.min(data, 0), np.max(data, 0)
+    )
     it.add_data(data)
     # get PID terms
     mi = it.mutual_info([0, 1, 1, 1])
@@ -73,132 +100,1135 @@ def pid_4d(df, g, k, pw, t, cond, phasic=True):
     u3 = it.unique_info([0, 2, 3, 1])  # the unique variable is where the 1 is!!!!
     r = it.redundant_info([0, 1, 2, 3])
     s = it.synergy([0, 1, 2, 3])
-    rnd = lambda x: np.round(x, decimals=4)
     return rnd(mi), rnd(u1), rnd(u2), rnd(u3), rnd(r), rnd(s)
 
 
+def pid_3d(df, g, k, pw, t, cond, phasic=True, engine="numpy", index=None):
+    """3-dimensional partial information decomposition (2 inputs, 1 target)"""
+    cols = get_pid_cols(cond, phasic)  # get columns
+    data = filter_data(df, k, pw, t, g, index)[
+        cols
+    ].to_numpy()  # filter data and convert to numpy
+    return decompose_3d(data, engine)
+
+
+def pid_4d(df, g, k, pw, t, cond, phasic=True, engine="numpy", index=None):
+    """4-dimensional partial information decomposition (3 inputs, 1 target)"""
+    cols = get_pid_cols(cond, phasic)  # get columns
+    data = filter_data(df, k, pw, t, g, index)[
+        cols
+    ].to_numpy()  # filter data and convert to numpy
+    return decompose_4d(data, engine)
+
+
+# source axis summed out of the 4D joint distribution for each 3D decomposition
+excluded_axes = {"ex_excluded": 1, "in1_excluded": 2, "in2_excluded": 3}
+
+
+def pid_values(k, pid_4, pid_3):
+    """PID values for condition k, given functions for the 4D and 3D decompositions"""
+    mi = u1 = u2 = u3 = r = sy = mi_13 = r_13 = sy_13 = un_13 = 0
+    mi_12 = r_12 = sy_12 = un_12 = mi_23 = r_23 = sy_23 = un_23 = 0
+    if k == 1:
+        mi, u1, u2, u3, r, sy = pid_4()
+        mi_23, r_23, sy_23, un_23, un_32 = pid_3("ex_excluded")
+    if k != 3:
+        mi_13, r_13, sy_13, un_13, un_31 = pid_3("in1_excluded")
+    if k != 2:
+        mi_12, r_12, sy_12, un_12, un_21 = pid_3("in2_excluded")
+    return [
+        mi,
+        u1,
+        u2,
+        u3,
+        r,
+        sy,
+        mi_13,
+        r_13,
+        sy_13,
+        un_13,
+        mi_12,
+        r_12,
+        sy_12,
+        un_12,
+        mi_23,
+        r_23,
+        sy_23,
+        un_23,
+    ]
+
+
+def joint_pid_values(p, k):
+    """PID values for condition k from the 4D joint distribution of a cell"""
+    rnd = lambda x: tuple(np.round(x, decimals=4))
+    return pid_values(
+        k,
+        lambda: rnd(pid_engine.pid_4d_terms(p)),
+        lambda cond: rnd(pid_engine.pid_3d_terms(p.sum(axis=excluded_axes[cond]))),
+    )
+
+
+def pid_cell(data, k, engine="numpy", joint=True):
+    """PID values for one cell, from its array of 4D PID columns"""
+    if joint and engine == "numpy":
+        return joint_pid_values(pid_engine.joint_distribution(data), k)
+    return pid_values(
+        k,
+        lambda: decompose_4d(data, engine),
+        lambda cond: decompose_3d(np.delete(data, excluded_axes[cond], axis=1), engine),
+    )
+
+
+def epoch_pid_cells(data, k, engine="numpy", joint=True):
+    """PID values for one cell of each epoch, from the 4D PID columns of the epochs
+    side by side (e.g. phasic then tonic)"""
+    n_cols = len(pid_cols_dict["4D"])
+    return [
+        pid_cell(data[:, i : i + n_cols], k, engine, joint)
+        for i in range(0, data.shape[1], n_cols)
+    ]
+
+
+# worker processes memory-map the PID column block once, so tasks are only indices
+_worker_data = {}
+
+
+def _shared_pid_cell(path, start, stop, k, engine="numpy", joint=True):
+    """PID values of each epoch for the cell in rows start:stop of the shared block"""
+    if _worker_data.get("path") != path:
+        _worker_data["block"] = attach_array(path)
+        _worker_data["path"] = path
+    return epoch_pid_cells(_worker_data["block"][start:stop], k, engine, joint)
+
+
 # combine functions above to create full PID table
 
 
-def pid_analysis(df, phasic=True):
-    """creates table of PID values from data"""
+def pid_analysis(
+    df,
+    phasic=True,
+    engine="numpy",
+    joint=True,
+    index=None,
+    n_workers=1,
+    indices=None,
+    bin_counts=None,
+):
+    """creates table of PID values from data
+
+    With the numpy engine and joint=True, the 4D joint distribution of each cell
+    is built once and the 3D decompositions come from summing out one source.
+    Each cell is sliced from the group index (see util.group_index), which is
+    built from df if not given. With n_workers > 1, cells are computed in a
+    process pool and gathered in the same row order; the block is shared with
+    the workers as a memory-mapped file, so each task only sends row indices.
+    For surrogate data, indices gives the row order of each input column (see
+    util.surrogate_indices) and the columns are permuted without copying df.
+    With a list of bin_counts, the PID is swept over bin counts (see
+    sweep_pid_analysis) and the table gets an n_bins column.
+    """
+    block = df[get_pid_cols("4D", phasic)].to_numpy()
+    if indices is not None:
+        block = permute_columns(block, indices, [1, 2, 3])  # input columns
+    if bin_counts is not None:
+        if engine != "numpy":
+            raise ValueError("Invalid engine provided: bin_counts requires 'numpy'")
+        return sweep_pid_analysis(df, block, bin_counts, index)
+    return block_pid_analysis(df, block, engine, joint, index, n_workers)[0]
+
+
+def sweep_pid_cell(data, k, bin_counts):
+    """PID values for one cell at each bin count, all from one histogram of its
+    distinct rows (see pid_engine.aggregate_counts)"""
+    levels, counts = pid_engine.level_counts(data)
+    cell_vals = []
+    for n_bins in bin_counts:
+        joint = pid_engine.aggregate_counts(levels, counts, n_bins)
+        cell_vals.append(joint_pid_values(joint / joint.sum(), k))
+    return cell_vals
+
+
+def sweep_pid_analysis(df, block, bin_counts, index=None):
+    """creates table of PID values of a block of 4D PID columns at each bin count,
+    one table after another with an n_bins column"""
+    if index is None:
+        index = group_index(df)
+    cells = get_cells(df)
+    cell_vals = []
+    for cell in cells:
+        if cell[1:] == cells[0][1:]:  # for all trial groups
+            print("Calculating PID sweep for trials group " + str(cell[0]))
+        data = block[slice(*index[cell])]
+        cell_vals.append(sweep_pid_cell(data, cell[1], bin_counts))
+    tables = []
+    for i, n_bins in enumerate(bin_counts):
+        table = pid_table(cells, [vals[i] for vals in cell_vals])
+        table.insert(len(full_condition_cols), "n_bins", n_bins)
+        tables.append(table)
+    return pd.concat(tables).reset_index(drop=True)
+
+
+def epochs_pid_analysis(
+    df, epochs=(True, False), engine="numpy", joint=True, index=None, n_workers=1
+):
+    """creates tables of PID values for several epochs (phasic settings) at once
+
+    The epochs share their rows, so each cell is sliced once and decomposed for
+    every epoch in the same pass. Returns one table per epoch, each the same as
+    from pid_analysis.
+    """
+    cols = [col for epoch in epochs for col in get_pid_cols("4D", epoch)]
+    return block_pid_analysis(df, df[cols].to_numpy(), engine, joint, index, n_workers)
+
+
+def block_pid_analysis(
+    df, block, engine="numpy", joint=True, index=None, n_workers=1, cells=None
+):
+    """creates a table of PID values for each epoch of a block of 4D PID columns,
+    optionally for some cells only"""
+    if engine not in pid_engines:
+        raise ValueError("Invalid engine provided: must be 'numpy' or 'infotheory'")
+    if index is None:
+        index = group_index(df)
+    if cells is None:
+        cells = get_cells(df)
+    if not cells:
+        n_epochs = block.shape[1] // len(pid_cols_dict["4D"])
+        return [pid_table([], []) for i in range(n_epochs)]
+    progress = instrument.progress(len(cells))
+    cell_vals = []
+    if n_workers > 1:
+        print(f"Calculating PID for {len(cells)} cells on {n_workers} workers")
+        starts, stops = zip(*[index[cell] for cell in cells])
+        cell_k = [cell[1] for cell in cells]
+        with shared_array(block) as block_path, ProcessPoolExecutor(
+            max_workers=n_workers
+        ) as executor:
+            for vals in executor.map(
+                _shared_pid_cell,
+                itertools.repeat(block_path),
+                starts,
+                stops,
+                cell_k,
+                itertools.repeat(engine),
+                itertools.repeat(joint),
+                chunksize=max(1, len(cells) // (4 * n_workers)),
+            ):
+                cell_vals.append(vals)
+                progress()
+    else:
+        for cell in cells:
+            if cell[1:] == cells[0][1:]:  # for all trial groups
+                print("Calculating PID for trials group " + str(cell[0]))
+            data = block[slice(*index[cell])]
+            cell_vals.append(epoch_pid_cells(data, cell[1], engine, joint))
+            progress()
+    return [pid_table(cells, epoch_vals) for epoch_vals in zip(*cell_vals)]
+
+
+# N-SOURCE PID
+# Decomposes a target over any list of source columns (e.g. the *_all_* counts as
+# well as the pathway counts), with the joint distribution stored sparsely so
+# memory grows with the number of trials rather than bins ** dims.
+
+
+def pid_sources(df, source_cols, target_col="postsynaptic_ph", index=None):
+    """creates table of PID values of a target and any number of source columns
+
+    Each cell gets the mutual information, the unique information of each source
+    (as u_ + column name), the redundancy and the synergy (see
+    pid_engine.sparse_pid_terms). Unlike pid_analysis, terms are computed for
+    every k_condition. Columns outside the standard combined data, such as the
+    *_all_* counts, can be loaded with util.load_combined_data(extra_cols=...).
+    """
+    if index is None:
+        index = group_index(df)
+    block = df[[target_col] + list(source_cols)].to_numpy()
+    cells = get_cells(df)
+    rows = []
+    for cell in cells:
+        if cell[1:] == cells[0][1:]:  # for all trial groups
+            print("Calculating PID for trials group " + str(cell[0]))
+        data = block[slice(*index[cell])]
+        terms = pid_engine.sparse_pid_terms(*pid_engine.sparse_joint_distribution(data))
+        rows.append(list(cell) + list(np.round(terms, decimals=4)))
+    value_cols = ["mi"] + ["u_" + col for col in source_cols] + ["r", "sy"]
+    return pd.DataFrame(rows, columns=full_condition_cols + value_cols, dtype=float)
+
+
+# STREAMED PID
+# For data spilled to disk by util.load_spilled_data, cells are read one condition
+# at a time, so the combined table is never held in memory. The cell cache is not
+# used on this path.
+
+
+def streamed_cells(spill_dir, epochs=(True, False)):
+    """yields (cell, block) of spilled data, where block holds the 4D PID columns of
+    the epochs side by side"""
+    cols = [col for epoch in epochs for col in get_pid_cols("4D", epoch)]
+    for cell, records in iter_spilled_groups(spill_dir):
+        yield cell, np.stack([records[col] for col in cols], axis=1)
+
+
+def cell_order(cells):
+    """returns the cells of the PID table, ordered as get_cells orders them"""
+    values = [list(dict.fromkeys(cell[i] for cell in cells)) for i in range(4)]
+    return list(itertools.product(*values))
+
+
+def streamed_pid_analysis(spill_dir, epochs=(True, False), engine="numpy", joint=True):
+    """creates tables of PID values for each epoch from spilled data, the same as
+    epochs_pid_analysis on the combined data"""
+    if engine not in pid_engines:
+        raise ValueError("Invalid engine provided: must be 'numpy' or 'infotheory'")
+    progress = instrument.progress()  # the number of cells is not known ahead
+    cell_vals = {}
+    for cell, block in streamed_cells(spill_dir, epochs):
+        if cell[0] == 1:  # first trials group of each condition
+            print(f"Calculating PID for condition {cell[1:]}")
+        cell_vals[cell] = epoch_pid_cells(block, cell[1], engine, joint)
+        progress()
+    cells = cell_order(list(cell_vals))
+    return [
+        pid_table(cells, [cell_vals[cell][i] for cell in cells])
+        for i in range(len(epochs))
+    ]
+
+
+def streamed_mi_null_tables(spill_dir, epochs=(True, False)):
+    """creates tables of MI null parameters for each epoch from spilled data"""
+    n_cols = len(pid_cols_dict["4D"])
+    cell_nulls = {
+        cell: [
+            cell_mi_null(block[:, i : i + n_cols])
+            for i in range(0, block.shape[1], n_cols)
+        ]
+        for cell, block in streamed_cells(spill_dir, epochs)
+    }
+    cells = cell_order(list(cell_nulls))
+    return [
+        null_table(cells, [cell_nulls[cell][i] for cell in cells])
+        for i in range(len(epochs))
+    ]
+
+
+# BOOTSTRAP CONFIDENCE INTERVALS
+# Instead of resampling rows through the PID functions, each replicate redraws the
+# counts of a cell's distinct rows (its finest histogram, see
+# pid_engine.level_counts) multinomially. Every distinct row adds to one bin of
+# each shifted binning, so a sparse incidence matrix turns a batch of draws into
+# a batch of joint tables, which are decomposed together.
+
+
+def batch_joint_pid_values(p, k):
+    """PID values for condition k of a batch of 4D joint tables, shape (batch, 18)"""
+    vals = pid_values(
+        k,
+        lambda: pid_engine.batch_pid_4d_terms(p),
+        lambda cond: pid_engine.batch_pid_3d_terms(p.sum(axis=excluded_axes[cond] + 1)),
+    )
+    return np.stack([np.broadcast_to(val, p.shape[:1]) for val in vals], axis=1)
+
+
+def bootstrap_pid_cell(data, k, n_boot=1000, rng=None, batch_size=100):
+    """PID values of bootstrap replicates of one cell, shape (n_boot, 18)"""
+    if rng is None:
+        rng = np.random.default_rng()
+    levels, counts = pid_engine.level_counts(data)
+    codes = pid_engine.bin_codes(levels)  # bin edges of the original cell
+    n_reps, n_levels, dims = codes.shape
+    shape = (pid_engine.n_bins,) * dims
+    flat = np.ravel_multi_index(tuple(codes.reshape(-1, dims).T), shape)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(flat)), (np.tile(np.arange(n_levels), n_reps), flat)),
+        shape=(n_levels, int(np.prod(shape))),
+    )
+    boot_vals = []
+    for start in range(0, n_boot, batch_size):
+        size = min(batch_size, n_boot - start)
+        draws = rng.multinomial(len(data), counts / len(data), size=size)
+        tables = incidence.T.dot(draws.T).T / (len(data) * n_reps)
+        boot_vals.append(batch_joint_pid_values(tables.reshape((size,) + shape), k))
+    return np.concatenate(boot_vals)
+
+
+def bootstrap_cis(df, phasic=True, index=None, n_boot=1000, confidence=0.95, seed=0):
+    """creates table of bias-corrected bootstrap estimates of the mean PID values
+    of each condition across trials groups, with their basic bootstrap confidence
+    intervals, as pid_value_cols + '_bc', '_bc_ci_low' and '_bc_ci_high'
+
+    Each replicate of a condition averages one replicate of each of its trials
+    groups, as the means of final_results do. Replicates carry the upward bias of
+    plug-in information on top of that of the estimate, so the intervals reflect
+    them about the estimate (2 * estimate - upper and lower percentiles). They
+    bound the bias-corrected estimate (2 * estimate - mean replicate), not the
+    plug-in mean, which they lie below where its bias is larger than its spread,
+    as in small cells.
+    """
+    if index is None:
+        index = group_index(df)
+    block = df[get_pid_cols("4D", phasic)].to_numpy()
+    rng = np.random.default_rng(seed)
+    cells = get_cells(df)
+    sums, estimates, n_groups = {}, {}, {}
+    for cell in cells:
+        if cell[1:] == cells[0][1:]:  # for all trial groups
+            print("Bootstrapping PID for trials group " + str(cell[0]))
+        data = block[slice(*index[cell])]
+        p = pid_engine.joint_distribution(data)
+        estimate = batch_joint_pid_values(p[None], cell[1])[0]
+        boot_vals = bootstrap_pid_cell(data, cell[1], n_boot, rng)
+        sums[cell[1:]] = sums.get(cell[1:], 0) + boot_vals
+        estimates[cell[1:]] = estimates.get(cell[1:], 0) + estimate
+        n_groups[cell[1:]] = n_groups.get(cell[1:], 0) + 1
+    alpha = (1 - confidence) / 2 * 100
+    rows = []
+    for key in sums:
+        means = sums[key] / n_groups[key]
+        estimate = estimates[key] / n_groups[key]
+        upper, lower = 2 * estimate - np.percentile(means, [alpha, 100 - alpha], 0)
+        corrected = 2 * estimate - means.mean(0)
+        bounds = np.stack([corrected, lower, upper], axis=1)
+        rows.append(list(key) + list(np.round(bounds.ravel(), 4)))
+    ci_cols = [
+        col + end
+        for col in pid_value_cols
+        for end in ["_bc", "_bc_ci_low", "_bc_ci_high"]
+    ]
+    return pd.DataFrame(rows, columns=condition_cols + ci_cols, dtype=float)
+
+
+# ONLINE PID
+# While a simulation is still writing its .dat files, the rows appended so far are
+# folded into a running joint histogram of each condition (all trials groups
+# together). Unless given, the bin edges of a condition are fixed from its first
+# warm_up rows, which are buffered until there are enough of them, as edges from
+# a few rows would put later rows in the edge bins. PID values are recomputed from
+# the counts.
+
+
+def online_state(phasic=True, edges=None, warm_up=1000):
+    """creates an empty online PID state
+
+    edges optionally maps conditions (k_condition, pathway, learning_time) to
+    the (mins, maxs) of their 4D PID columns, fixing the bin edges up front.
+    Otherwise, the rows of a condition are held back until there are warm_up of
+    them, and the edges are taken from those.
+    """
+    return {
+        "phasic": phasic,
+        "edges": dict(edges or {}),
+        "warm_up": warm_up,
+        "buffers": {},
+        "counts": {},
+        "offsets": {},
+    }
+
+
+def fold_rows(state, df):
+    """adds rows of spiking data to the joint histograms of their conditions,
+    buffering the rows of conditions without bin edges until the warm-up"""
+    for key, group in df.groupby(condition_cols):
+        key = tuple(float(value) for value in key)
+        block = group[get_pid_cols("4D", state["phasic"])].to_numpy()
+        if key not in state["edges"]:
+            buffer = state["buffers"].get(key)
+            if buffer is not None:
+                block = np.concatenate([buffer, block])
+            if len(block) < state["warm_up"]:
+                state["buffers"][key] = block
+                continue
+            state["buffers"].pop(key, None)
+            state["edges"][key] = (np.min(block, 0), np.max(block, 0))
+        mins, maxs = state["edges"][key]
+        codes = pid_engine.bin_codes(block, mins=mins, maxs=maxs)
+        counts = pid_engine.joint_counts(codes)
+        state["counts"][key] = state["counts"].get(key, 0) + counts
+    return state
+
+
+def fold_new_rows(state, filepaths):
+    """adds the rows appended to .dat files since they were last read"""
+    for filepath in filepaths:
+        offset = state["offsets"].get(str(filepath), 0)
+        df, state["offsets"][str(filepath)] = read_new_rows(filepath, offset)
+        fold_rows(state, df)
+    return state
+
+
+def online_pid(state):
+    """creates table of PID values of each condition from the running histograms,
+    with the number of rows folded in so far (conditions still in their warm-up
+    are left out)"""
+    n_reps = 2 * pid_engine.n_shifts + 1
+    rows = []
+    for key in sorted(state["counts"]):
+        counts = state["counts"][key]
+        p = counts / counts.sum()
+        rows.append(list(key) + [counts.sum() / n_reps] + joint_pid_values(p, key[0]))
+    return pd.DataFrame(
+        rows, columns=condition_cols + ["n_rows"] + pid_value_cols, dtype=float
+    )
+
+
+def save_online_state(state, path):
+    """writes an online PID state, replacing any existing file in one step"""
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_online_state(path):
+    """reads an online PID state written by save_online_state"""
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+# PID CELL CACHE
+# Each cell's PID values are stored under a hash of its input rows, the columns
+# used, the binning and the engine version, so reruns after new data only compute
+# the cells that are new or changed. There is a cache file per condition and
+# epoch, so runs of different conditions never write the same file, and each
+# write keeps only the keys of the current data, so replaced cells do not pile up.
+
+engine_versions = {"numpy": pid_engine.version, "infotheory": infotheory.__version__}
+
+
+def cell_key(data, cols, k, engine="numpy"):
+    """returns a hash of a cell's rows of the given columns, k and PID settings"""
+    key = hashlib.sha1(np.ascontiguousarray(data).tobytes())
+    settings = (str(data.dtype), data.shape, list(cols), float(k))
+    settings += (pid_engine.n_bins, pid_engine.n_shifts, engine_versions[engine])
+    key.update(repr(settings + (engine,)).encode())
+    return key.hexdigest()
+
+
+def cell_cache_path(condition, phasic=True):
+    """returns the path of the cell cache of a condition and epoch"""
+    return os.path.join(cache_dir, f"pid_cells_{condition}_{phasic_names[phasic]}")
+
+
+def read_cell_cache(condition, phasic=True):
+    """returns dict of cached PID values by cell key"""
+    path = cell_cache_path(condition, phasic)
+    if not os.path.isfile(path):
+        return {}
+    cache = pd.read_feather(path)
+    return dict(zip(cache["key"], cache[pid_value_cols].to_numpy().tolist()))
+
+
+def write_cell_cache(cache, condition, phasic=True):
+    """writes the PID values by cell key, replacing the cache in one step"""
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    path = cell_cache_path(condition, phasic)
+    table = pd.DataFrame(list(cache.values()), columns=pid_value_cols, dtype=float)
+    table.insert(0, "key", list(cache.keys()))
+    table.to_feather(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def cached_epochs_pid_analysis(
+    df, condition, epochs=(True, False), engine="numpy", index=None, n_workers=1
+):
+    """creates tables of PID values as epochs_pid_analysis, computing only the
+    cells that are not in the cell cache of the condition, which is then
+    rewritten with the cells of df only"""
+    if index is None:
+        index = group_index(df)
+    cells = get_cells(df)
+    epoch_cols = [get_pid_cols("4D", epoch) for epoch in epochs]
+    block = df[[col for cols in epoch_cols for col in cols]].to_numpy()
+    n_cols = len(pid_cols_dict["4D"])
+    keys = {}
+    for cell in cells:
+        data = block[slice(*index[cell])]
+        keys[cell] = [
+            cell_key(data[:, i * n_cols : (i + 1) * n_cols], cols, cell[1], engine)
+            for i, cols in enumerate(epoch_cols)
+        ]
+
+    with instrument.stage("read_cache"):
+        caches = [read_cell_cache(condition, epoch) for epoch in epochs]
+    todo_cells = [
+        cell
+        for cell in cells
+        if not all(key in cache for key, cache in zip(keys[cell], caches))
+    ]
+    print(f"{len(cells) - len(todo_cells)} of {len(cells)} cells found in cache")
+    if todo_cells:
+        tables = block_pid_analysis(
+            df, block, engine, index=index, n_workers=n_workers, cells=todo_cells
+        )
+        for i, table in enumerate(tables):
+            for cell, vals in zip(todo_cells, table[pid_value_cols].to_numpy()):
+                caches[i][keys[cell][i]] = vals.tolist()
+    for i, epoch in enumerate(epochs):
+        cache = {keys[cell][i]: caches[i][keys[cell][i]] for cell in cells}
+        if len(cache) < len(caches[i]) or todo_cells:
+            with instrument.stage("write_cache"):
+                write_cell_cache(cache, condition, epoch)
+        caches[i] = cache
+    return [
+        pid_table(cells, [caches[i][keys[cell][i]] for cell in cells])
+        for i in range(len(epochs))
+    ]
+
+
+def get_cells(df):
+    """returns (trials_group, k_condition, pathway, learning_time) of each PID row"""
     g_values = df["trials_group"].unique().tolist()
     k_values = df["k_condition"].unique().tolist()
     pw_values = df["pathway"].unique().tolist()
     t_values = df["learning_time"].unique().tolist()
-    n_rows = len(g_values) * len(k_values) * len(pw_values) * len(t_values)
-    df_pid = pd.DataFrame(index=range(n_rows), columns=pid_cols)
-    row_idx = 0
-    for g in g_values:  # for all trial groups
-        print("Calculating PID for trials group " + str(g))
-        for k in k_values:  # for all conditions
-            for pw in pw_values:  # loop over pathways
-                for t in t_values:  # loop over time points
-                    mi = u1 = u2 = u3 = r = sy = mi_13 = r_13 = sy_13 = un_13 = 0
-                    mi_12 = r_12 = sy_12 = un_12 = mi_23 = r_23 = sy_23 = un_23 = 0
-                    if k == 1:
-                        mi, u1, u2, u3, r, sy = pid_4d(df, g, k, pw, t, "4D", phasic)
-                        mi_23, r_23, sy_23, un_23, un_32 = pid_3d(
-                            df, g, k, pw, t, "ex_excluded", phasic
-                        )
-                    if k != 3:
-                        mi_13, r_13, sy_13, un_13, un_31 = pid_3d(
-                            df, g, k, pw, t, "in1_excluded", phasic
-                        )
-                    if k != 2:
-                        mi_12, r_12, sy_12, un_12, un_21 = pid_3d(
-                            df, g, k, pw, t, "in2_excluded", phasic
-                        )
-                    vals = [
-                        g,
-                        k,
-                        pw,
-                        t,
-                        mi,
-                        u1,
-                        u2,
-                        u3,
-                        r,
-                        sy,
-                        mi_13,
-                        r_13,
-                        sy_13,
-                        un_13,
-                        mi_12,
-                        r_12,
-                        sy_12,
-                        un_12,
-                        mi_23,
-                        r_23,
-                        sy_23,
-                        un_23,
-                    ]
-                    row_vals = {name: val for name, val in zip(pid_cols, vals)}
-                    df_pid.loc[row_idx] = row_vals
-                    row_idx += 1
-    return df_pid
+    return list(itertools.product(g_values, k_values, pw_values, t_values))
+
+
+def pid_table(cells, cell_vals):
+    """creates table of PID values from cells and their PID values"""
+    rows = [list(cell) + vals for cell, vals in zip(cells, cell_vals)]
+    return pd.DataFrame(rows, columns=pid_cols, dtype=float)
+
+
+# ANALYTIC MI NULL
+# sig_test.analytic_p_values tests the MI columns against a chi-square null, which
+# needs the G statistic of each cell and its null mean and variance.
+
+# null columns of each MI column (see pid_engine.g_statistics)
+mi_null_suffixes = ["_g", "_dof", "_null_mean", "_null_var"]
+
+
+def cell_mi_null(data):
+    """sample count, then the G statistics, chi-square degrees of freedom and
+    null mean and variance of the G statistics of the MI columns of a cell,
+    from the unshifted binning of its 4D PID columns"""
+    null = pid_engine.g_statistics(data, [mi_source_axes[col] for col in mi_cols])
+    return [len(data)] + [float(x) for values in null for x in values]
+
+
+def mi_null_table(df, phasic=True, index=None):
+    """creates table of sample counts and G statistics with their null
+    parameters for the MI columns of each cell (see cell_mi_null)"""
+    if index is None:
+        index = group_index(df)
+    block = df[get_pid_cols("4D", phasic)].to_numpy()
+    cells = get_cells(df)
+    return null_table(
+        cells, [cell_mi_null(block[slice(*index[cell])]) for cell in cells]
+    )
+
+
+def null_table(cells, cell_nulls):
+    """creates table of MI null parameters from cells and their parameters"""
+    rows = [list(cell) + vals for cell, vals in zip(cells, cell_nulls)]
+    null_cols = ["n_samples"] + [
+        col + suffix for suffix in mi_null_suffixes for col in mi_cols
+    ]
+    return pd.DataFrame(
+        rows, columns=trials_group_cols + condition_cols + null_cols, dtype=float
+    )
+
+
+# SURROGATE PID
+# Shuffling within a cell keeps each column's min and max, so the cells are binned
+# once and each surrogate only permutes the input codes and rebuilds the histogram.
+
+
+def cell_codes(block, index):
+    """returns bin codes of every row, binned cell by cell, shape (reps, rows, 4)"""
+    n_reps = 2 * pid_engine.n_shifts + 1
+    codes = np.empty((n_reps,) + block.shape, dtype=np.uint8)
+    for start, stop in index.values():
+        codes[:, start:stop] = pid_engine.bin_codes(block[start:stop])
+    return codes
+
+
+def surrogate_pid_values(codes, target_code, index, cells, indices):
+    """PID values of each cell for surrogate data with input rows reordered by indices
+
+    target_code is the (fixed) target's part of the flattened joint code.
+    """
+    n_bins = pid_engine.n_bins
+    flat = target_code.copy()
+    for col, col_indices in zip([1, 2, 3], indices):
+        flat += codes[:, col_indices, col].astype(np.int32) * n_bins ** (3 - col)
+    cell_vals = []
+    for cell in cells:
+        start, stop = index[cell]
+        counts = np.bincount(flat[:, start:stop].ravel(), minlength=n_bins**4)
+        p = counts.reshape((n_bins,) * 4) / counts.sum()
+        cell_vals.append(joint_pid_values(p, cell[1]))
+    return cell_vals
+
+
+def _shared_surrogate_values(codes_path, target_path, index, cells, rng_seed):
+    """surrogate PID values for one seed, from shared codes"""
+    codes = attach_array(codes_path)
+    target_code = attach_array(target_path)
+    seed, indices = next(surrogate_indices(index, 3, [rng_seed]))
+    return surrogate_pid_values(codes, target_code, index, cells, indices)
+
 
+def shard_path(shard_dir, random_seed):
+    """returns path of the surrogate PID shard for a random seed"""
+    return os.path.join(shard_dir, f"surrogate_seed_{random_seed}")
 
+
+def shards_key(spiking_files, engine="numpy"):
+    """returns a hash of the spiking files and PID settings that surrogate shards
+    are computed from, so shards of older data or engines are never resumed"""
+    settings = (pid_engine.n_bins, pid_engine.n_shifts, engine_versions[engine])
+    return files_key(spiking_files, engine, settings)
+
+
+def write_shard(pid, shard_dir, random_seed):
+    """writes one surrogate PID table, replacing any existing shard in one step"""
+    path = shard_path(shard_dir, random_seed)
+    pid.to_feather(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def merge_surrogate_shards(shard_dir, random_seeds):
+    """combines surrogate PID shards into one table, in random seed order"""
+    missing = [
+        seed for seed in random_seeds if not os.path.isfile(shard_path(shard_dir, seed))
+    ]
+    if missing:
+        raise ValueError(f"Missing surrogate shards for random seeds {missing}")
+    pid_dfs = [pd.read_feather(shard_path(shard_dir, seed)) for seed in random_seeds]
+    return pd.concat(pid_dfs).reset_index(drop=True)
+
+
+def pid_surrogates(
+    df,
+    phasic=True,
+    random_seeds=(0,),
+    index=None,
+    n_workers=1,
+    engine="numpy",
+    shard_dir=None,
+    resume=True,
+    rng_seeds=None,
+    cells=None,
+):
+    """creates table of surrogate PID values for each random seed
+
+    With the numpy engine each cell is binned once; for every seed only the input
+    codes are permuted (as by util.surrogate_indices) and the joint histogram is
+    rebuilt. With n_workers > 1, seeds are computed in a process pool that shares
+    the codes. If shard_dir is given, each seed's table is written there as soon
+    as it is done, and with resume=True seeds already on disk are skipped.
+    rng_seeds optionally gives the seed (or SeedSequence) that generates each
+    random seed's permutations; by default the random seeds themselves are used.
+    cells optionally restricts the table to some cells (numpy engine only).
+    """
+    if engine != "numpy" and cells is not None:
+        raise ValueError("Invalid engine provided: cells requires 'numpy'")
+    if index is None:
+        index = group_index(df)
+    random_seeds = list(random_seeds)
+    rng_seeds = dict(zip(random_seeds, rng_seeds or random_seeds))
+    pid_dfs = {}
+    if shard_dir is not None:
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        if resume:
+            for seed in random_seeds:
+                if os.path.isfile(shard_path(shard_dir, seed)):
+                    pid_dfs[seed] = None  # on disk, read when merging
+            print(f"{len(pid_dfs)} surrogate datasets already exist")
+    todo_seeds = [seed for seed in random_seeds if seed not in pid_dfs]
+    todo_indices = surrogate_indices(index, 3, [rng_seeds[seed] for seed in todo_seeds])
+
+    if cells is None:
+        cells = get_cells(df)
+    progress = instrument.progress(len(todo_seeds) * len(cells))
+
+    def save(random_seed, pid):
+        """adds the random seed to a surrogate table and keeps or writes it"""
+        pid["random_seed"] = random_seed
+        if shard_dir is not None:
+            with instrument.stage("write"):
+                write_shard(pid, shard_dir, random_seed)
+        pid_dfs[random_seed] = pid
+        progress(len(cells))
+
+    def shuffled_indices():
+        """yields the random seeds to do with their permutations, timed"""
+        for random_seed in todo_seeds:
+            with instrument.stage("shuffle"):
+                rng_seed, indices = next(todo_indices)
+            yield random_seed, indices
+
+    if engine != "numpy":
+        for random_seed, indices in shuffled_indices():
+            print(f"Surrogate dataset {random_seed}")
+            with instrument.stage("pid"):
+                pid = pid_analysis(
+                    df,
+                    phasic,
+                    engine,
+                    index=index,
+                    n_workers=n_workers,
+                    indices=indices,
+                )
+            save(random_seed, pid)
+    elif todo_seeds:
+        with instrument.stage("bin"):
+            codes = cell_codes(df[get_pid_cols("4D", phasic)].to_numpy(), index)
+            target_code = codes[:, :, 0].astype(np.int32) * pid_engine.n_bins**3
+        if n_workers > 1:
+            print(f"Calculating {len(todo_seeds)} surrogates on {n_workers} workers")
+            with instrument.stage("pid"):
+                with shared_array(codes) as codes_path, shared_array(
+                    target_code
+                ) as target_path, ProcessPoolExecutor(
+                    max_workers=n_workers
+                ) as executor:
+                    futures = {
+                        executor.submit(
+                            _shared_surrogate_values,
+                            codes_path,
+                            target_path,
+                            index,
+                            cells,
+                            rng_seeds[random_seed],
+                        ): random_seed
+                        for random_seed in todo_seeds
+                    }
+                    for future in as_completed(futures):
+                        print(f"Surrogate dataset {futures[future]}")
+                        save(futures[future], pid_table(cells, future.result()))
+        else:
+            for random_seed, indices in shuffled_indices():
+                print(f"Surrogate dataset {random_seed}")
+                with instrument.stage("pid"):
+                    cell_vals = surrogate_pid_values(
+                        codes, target_code, index, cells, indices
+                    )
+                save(random_seed, pid_table(cells, cell_vals))
+    if shard_dir is not None:
+        return merge_surrogate_shards(shard_dir, random_seeds)
+    return pd.concat([pid_dfs[seed] for seed in random_seeds]).reset_index(drop=True)
+
+
+def adaptive_surrogates(
+    df,
+    results,
+    phasic=True,
+    random_seeds=(0,),
+    index=None,
+    n_workers=1,
+    batch_size=2,
+    p_value=0.05,
+    confidence=0.99,
+    shard_dir=None,
+    resume=True,
+):
+    """creates table of surrogate PID values, stopping early for decided conditions
+
+    Surrogates are drawn batch_size random seeds at a time. After each batch the
+    test of every condition against the results table is bounded (see
+    sig_test.undecided_groups), and later seeds only compute the cells of
+    conditions whose significance at p_value could still change within
+    len(random_seeds) surrogates, so conditions get different numbers of
+    surrogates.
+    """
+    if index is None:
+        index = group_index(df)
+    random_seeds = list(random_seeds)
+    cells = get_cells(df)
+    undecided = set(cell[1:] for cell in cells)
+    pid_dfs = []
+    surrogates = pid_table([], [])  # without seeds, no surrogates
+    for i in range(0, len(random_seeds), batch_size):
+        batch_seeds = random_seeds[i : i + batch_size]
+        pid_dfs.append(
+            pid_surrogates(
+                df,
+                phasic,
+                batch_seeds,
+                index,
+                n_workers,
+                shard_dir=shard_dir,
+                resume=resume,
+                cells=[cell for cell in cells if cell[1:] in undecided],
+            )
+        )
+        surrogates = pd.concat(pid_dfs).reset_index(drop=True)
+        undecided &= undecided_groups(
+            results, surrogates, len(random_seeds), p_value, confidence
+        )
+        n_done = i + len(batch_seeds)
+        print(f"{len(undecided)} conditions undecided after {n_done} surrogates")
+        if not undecided:
+            break
+    return surrogates
+
+
+@instrument.traced("generate_pid_results")
 def generate_pid_results(
-    condition="Hebbian", phasic=True, surrogate=False, seed=0, n_surrogates=1
+    condition="Hebbian",
+    phasic=True,
+    surrogate=False,
+    seed=0,
+    n_surrogates=1,
+    engine="numpy",
+    n_workers=1,
+    resume=True,
+    adaptive=False,
+    cache=True,
+    stream=False,
+    n_boot=0,
+    mi_null=False,
 ):
-    """generates final PID results from spiking data"""
+    """generates final PID results from spiking data
+
+    With phasic=None, the phasic and tonic results are generated together: the
+    data are loaded once and both epochs are decomposed in the same pass over the
+    cells. For surrogates, seed may then be a dict of seeds by phasic setting.
+    Surrogate datasets are checkpointed one seed at a time in a shards folder;
+    with resume=True, seeds from an interrupted run are not recomputed. With
+    adaptive=True, surrogates stop early for conditions whose significance is
+    already decided (see adaptive_surrogates), which needs the results first.
+    With cache=True, results are always reassembled from the PID cell cache (see
+    cached_epochs_pid_analysis), so only new or changed cells are computed.
+    With stream=True, results are computed from data spilled to disk one
+    condition at a time (see util.load_spilled_data), for schemes larger than
+    memory; the cell cache is not used then. With n_boot > 0, final results get
+    bias-corrected means with bootstrap confidence intervals from n_boot
+    replicates (see bootstrap_cis). With mi_null=True, the MI null data of the
+    analytic test (see sig_test.analytic_p_values) are saved too; these permute
+    the target of every cell many times, so they take several times as long as
+    the PIDs. Each call is traced (see instrument.run), with the time of each
+    stage and progress through the cells.
+    """
     if condition not in ["Hebbian", "Hebbian_antiHebbian", "Hebbian_scaling"]:
         raise ValueError(
             "Invalid condition provided: must be 'Hebbian', 'Hebbian_antiHebbian' "
             "or 'Hebbian_scaling'"
         )
-    phasic_name = phasic_names[phasic]
+    if stream and (surrogate or n_boot):
+        raise ValueError("Invalid mode provided: stream is only for results")
+    cache = cache and not stream
+    epochs = [True, False] if phasic is None else [phasic]
+    seeds = seed if isinstance(seed, dict) else {epoch: seed for epoch in epochs}
 
-    results = "results"
     dir = os.path.join(results_dir, condition)
     if surrogate:
-        results = f"surrogate_{str(seed)}"
         dir = os.path.join(surrogates_dir, condition)
 
+    def results_file(epoch):
+        """name of the trials table of an epoch"""
+        results = f"surrogate_{str(seeds[epoch])}" if surrogate else "results"
+        return f"trials_{results}_{phasic_names[epoch]}"
+
     # check if exists already:
-    if os.path.isfile(os.path.join(dir, f"trials_{results}_{phasic_name}")):
-        print(f"{results} data already exists for {phasic_name} {condition} condition")
+    todo_epochs = []
+    for epoch in epochs:
+        output_files = [results_file(epoch)]
+        if mi_null and not surrogate:
+            output_files.append(f"mi_null_{phasic_names[epoch]}")
+        if cache and not surrogate:
+            todo_epochs.append(epoch)  # the cell cache decides what to compute
+        elif all(os.path.isfile(os.path.join(dir, file)) for file in output_files):
+            print(f"{results_file(epoch)} already exists for {condition} condition")
+        else:
+            todo_epochs.append(epoch)
+    if not todo_epochs:
         return
     if not os.path.exists(dir):
         os.makedirs(dir)
 
     spiking_files = spiking_files_dict[condition]
     print(f"Processing data ({condition})")
-    spiking = combine_data(spiking_files)
+    with instrument.stage("load"):
+        if stream:
+            spill_dir = load_spilled_data(spiking_files)
+        else:
+            spiking, index = load_combined_data(
+                spiking_files, return_index=True, n_workers=n_workers
+            )
 
     if surrogate:
-        pid_dfs = []
-        random_seed = seed * n_surrogates
-        for i in range(n_surrogates):
-            print(f"Surrogate dataset {random_seed}")
-            print(f"Shuffling data ({condition})")
-            shuffled_spiking = shuffle_data(spiking, phasic, random_seed)
-
-            print(f"Generating PIDs ({condition})")
-            pid = pid_analysis(shuffled_spiking, phasic)
-            pid["random_seed"] = random_seed
-            pid_dfs.append(pid)
+        key = shards_key(spiking_files, "numpy" if adaptive else engine)
+        for epoch in todo_epochs:
+            phasic_name = phasic_names[epoch]
+            seed = seeds[epoch]
+            random_seeds = range(seed * n_surrogates, (seed + 1) * n_surrogates)
+            print(f"Generating {phasic_name} surrogate PIDs ({condition})")
+            if adaptive:
+                results_path = os.path.join(
+                    results_dir, condition, f"trials_results_{phasic_name}"
+                )
+                if not os.path.isfile(results_path):
+                    raise ValueError(
+                        f"Results for {phasic_name} {condition} condition are "
+                        "needed for adaptive surrogates: run generate_pid first"
+                    )
+                surrogate_pids = adaptive_surrogates(
+                    spiking,
+                    pd.read_feather(results_path),
+                    epoch,
+                    random_seeds,
+                    index,
+                    n_workers,
+                    shard_dir=os.path.join(dir, f"shards_{phasic_name}_adaptive_{key}"),
+                    resume=resume,
+                )
+            else:
+                surrogate_pids = pid_surrogates(
+                    spiking,
+                    epoch,
+                    random_seeds,
+                    index,
+                    n_workers,
+                    engine,
+                    shard_dir=os.path.join(dir, f"shards_{phasic_name}_{key}"),
+                    resume=resume,
+                )
 
-            random_seed += 1
+            print(f"Saving results ({condition})")
+            with instrument.stage("write"):
+                surrogate_pids.to_feather(os.path.join(dir, results_file(epoch)))
+        return
 
-        print(f"Saving results ({condition})")
-        surrogate_pids = pd.concat(pid_dfs).reset_index(drop=True)
-        surrogate_pids.to_feather(os.path.join(dir, f"trials_{results}_{phasic_name}"))
-    else:
+    pid_epochs = [
+        epoch
+        for epoch in todo_epochs
+        if cache or not os.path.isfile(os.path.join(dir, results_file(epoch)))
+    ]
+    if pid_epochs:
         print(f"Generating PIDs ({condition})")
-        pid = pid_analysis(spiking, phasic)
-        pid.to_feather(os.path.join(dir, f"trials_{results}_{phasic_name}"))
-        pid = pd.read_feather(
-            os.path.join(dir, f"trials_results_{phasic_name}")
-        )  # preserve dtypes
-        result = (
-            pid.groupby(condition_cols)[pid_value_cols]
-            .agg(["mean", "std"])
-            .reset_index()
+        with instrument.stage("pid"):
+            if stream:
+                pids = streamed_pid_analysis(spill_dir, pid_epochs, engine)
+            elif cache:
+                pids = cached_epochs_pid_analysis(
+                    spiking,
+                    condition,
+                    pid_epochs,
+                    engine,
+                    index=index,
+                    n_workers=n_workers,
+                )
+            else:
+                pids = epochs_pid_analysis(
+                    spiking, pid_epochs, engine, index=index, n_workers=n_workers
+                )
+        for epoch, pid in zip(pid_epochs, pids):
+            phasic_name = phasic_names[epoch]
+            with instrument.stage("write"):
+                pid.to_feather(os.path.join(dir, results_file(epoch)))
+                pid = pd.read_feather(
+                    os.path.join(dir, f"trials_results_{phasic_name}")
+                )  # preserve dtypes
+            result = (
+                pid.groupby(condition_cols)[pid_value_cols]
+                .agg(["mean", "std"])
+                .reset_index()
+            )
+            result.columns = [
+                "{}_{}".format(col[0], col[1]) if col[1] else col[0]
+                for col in result.columns
+            ]
+            if n_boot:
+                with instrument.stage("bootstrap"):
+                    cis = bootstrap_cis(spiking, epoch, index, n_boot)
+                result = result.merge(cis, how="left", on=condition_cols)
+            with instrument.stage("write"):
+                result.to_feather(os.path.join(dir, f"final_results_{phasic_name}"))
+    if not mi_null:
+        return
+    print(f"Counting bins for the analytic MI test ({condition})")
+    with instrument.stage("mi_null"):
+        if stream:
+            nulls = streamed_mi_null_tables(spill_dir, todo_epochs)
+        else:
+            nulls = [mi_null_table(spiking, epoch, index) for epoch in todo_epochs]
+    with instrument.stage("write"):
+        for epoch, null in zip(todo_epochs, nulls):
+            null.to_feather(os.path.join(dir, f"mi_null_{phasic_names[epoch]}"))
+
+
+# SHARDED SURROGATE RUNS
+# Work units (condition, phasic, surrogate) are split across independent jobs that
+# share a filesystem. Each unit's permutations come from its own SeedSequence,
+# spawned as root -> condition -> phasic -> surrogate, so results do not depend on
+# how the units are split (or on n_surrogates).
+
+
+def surrogate_work_units(n_surrogates=10, root_seed=0):
+    """returns (condition, phasic, surrogate, seed sequence) of every work unit"""
+    units = []
+    condition_seqs = np.random.SeedSequence(root_seed).spawn(len(schemes))
+    for condition, condition_seq in zip(schemes, condition_seqs):
+        for phasic, phasic_seq in zip([True, False], condition_seq.spawn(2)):
+            for surrogate, seq in enumerate(phasic_seq.spawn(n_surrogates)):
+                units.append((condition, phasic, surrogate, seq))
+    return units
+
+
+def sharded_dir(condition, phasic, root_seed=0, engine="numpy"):
+    """returns folder of the per-surrogate shards of a sharded run, keyed by the
+    condition's spiking files and the engine (see shards_key)"""
+    phasic_name = phasic_names[phasic]
+    key = shards_key(spiking_files_dict[condition], engine)
+    return os.path.join(
+        surrogates_dir, condition, f"shards_{phasic_name}_root_{root_seed}_{key}"
+    )
+
+
+def generate_surrogate_shard(
+    shard=0, num_shards=1, n_surrogates=10, root_seed=0, engine="numpy", n_workers=1
+):
+    """generates the surrogate PIDs of the work units assigned to one shard
+
+    Units are dealt round-robin, so shard i of N takes units i, i + N, i + 2N, ...
+    Completed surrogates are skipped, so a shard can be rerun after a failure.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError("Invalid shard provided: must be in range(num_shards)")
+    units = surrogate_work_units(n_surrogates, root_seed)[shard::num_shards]
+    for condition in schemes:
+        condition_units = [unit for unit in units if unit[0] == condition]
+        if not condition_units:
+            continue
+        print(f"Processing data ({condition})")
+        spiking, index = load_combined_data(
+            spiking_files_dict[condition], return_index=True, n_workers=n_workers
         )
-        result.columns = [
-            "{}_{}".format(col[0], col[1]) if col[1] else col[0]
-            for col in result.columns
-        ]
-        result.to_feather(os.path.join(dir, f"final_results_{phasic_name}"))
+        for phasic in [True, False]:
+            phasic_units = [unit for unit in condition_units if unit[1] == phasic]
+            if not phasic_units:
+                continue
+            print(f"Generating {phasic_names[phasic]} surrogate PIDs ({condition})")
+            pid_surrogates(
+                spiking,
+                phasic,
+                [unit[2] for unit in phasic_units],
+                index,
+                n_workers,
+                engine,
+                shard_dir=sharded_dir(condition, phasic, root_seed, engine),
+                rng_seeds=[unit[3] for unit in phasic_units],
+            )
+
+
+def merge_surrogate_run(n_surrogates=10, root_seed=0, engine="numpy"):
+    """merges the shards of a sharded run into trials_surrogate tables"""
+    for condition in schemes:
+        for phasic in [True, False]:
+            phasic_name = phasic_names[phasic]
+            print(f"Merging {phasic_name} surrogate PIDs ({condition})")
+            surrogate_pids = merge_surrogate_shards(
+                sharded_dir(condition, phasic, root_seed, engine),
+                range(n_surrogates),
+            )
+            surrogate_pids.to_feather(
+                os.path.join(
+                    surrogates_dir,
+                    condition,
+                    f"trials_surrogate_root_{root_seed}_{phasic_name}",
+                )
+            )
@@ -0,0 +1,300 @@
+"""
+This file contains a NumPy implementation of the Williams-Beer partial
+information decomposition, matching the estimates of the infotheory library.
+"""
+
+import itertools
+import numpy as np
+
+# binning settings used throughout the analysis
+n_bins = 10  # equal interval bins along each dimension
+n_shifts = 3  # shifted binnings either side of the boundaries (infotheory nreps)
+version = 1  # increase when estimates change, invalidating cached PID values
+
+
+# BINNING
+
+
+def bin_boundaries(mins, maxs, n_bins=n_bins, n_shifts=n_shifts):
+    """returns shifted equal interval bin boundaries, shape (reps, dims, n_bins - 1)"""
+    mins = np.asarray(mins, dtype=float)
+    maxs = np.asarray(maxs, dtype=float)
+    steps = np.arange(1, n_bins, dtype=float)[None, :]
+    boundaries = mins[:, None] + steps * (maxs - mins)[:, None] / n_bins
+    # offsets follow infotheory: half a bin width split into n_shifts + 1 parts
+    # (the last boundary uses the offset of the one before it)
+    if n_bins > 2:
+        offset_width = np.diff(boundaries, axis=1) / 2
+        offset_width = np.concatenate([offset_width, offset_width[:, -1:]], axis=1)
+    else:
+        offset_width = (maxs - mins)[:, None] / n_bins / 2
+    unit_offset = (boundaries - (boundaries - offset_width)) / (n_shifts + 1)
+    reps = [boundaries]
+    reps += [boundaries - unit_offset * r for r in range(1, n_shifts + 1)]
+    reps += [
+        boundaries + unit_offset * r for r in range(n_shifts + 1, 2 * n_shifts + 1)
+    ]
+    return np.stack(reps)
+
+
+def bin_codes(data, n_bins=n_bins, n_shifts=n_shifts, mins=None, maxs=None):
+    """returns bin codes of data for each shifted binning, shape (reps, n, dims)"""
+    data = np.asarray(data)
+    if mins is None:
+        mins = np.min(data, 0)
+    if maxs is None:
+        maxs = np.max(data, 0)
+    boundaries = bin_boundaries(mins, maxs, n_bins, n_shifts)
+    n_reps, dims = boundaries.shape[:2]
+    code_dtype = np.uint8 if n_bins <= 256 else np.intp  # compact codes
+    codes = np.empty((n_reps, len(data), dims), dtype=code_dtype)
+    for r in range(n_reps):
+        for d in range(dims):
+            codes[r, :, d] = np.searchsorted(boundaries[r, d], data[:, d], side="right")
+    return codes
+
+
+def joint_counts(codes, n_bins=n_bins):
+    """returns dense joint histogram of bin codes summed over shifted binnings"""
+    dims = codes.shape[-1]
+    flat = np.ravel_multi_index(tuple(codes.reshape(-1, dims).T), (n_bins,) * dims)
+    counts = np.bincount(flat, minlength=n_bins**dims)
+    return counts.reshape((n_bins,) * dims)
+
+
+def joint_distribution(data, n_bins=n_bins, n_shifts=n_shifts):
+    """returns joint probability table of data, with the target on axis 0"""
+    counts = joint_counts(bin_codes(data, n_bins, n_shifts), n_bins)
+    return counts / counts.sum()
+
+
+# BIN COUNT SWEEPS
+# Shifted equal interval bins do not nest across bin counts, so coarse histograms
+# are re-aggregated from the finest one there is: the counts of the distinct rows
+# of the data (spike counts take few values). Each distinct row is binned once
+# per bin count and its count added to its bins, which gives exactly the joint
+# histogram of the full data.
+
+
+def level_counts(data):
+    """returns the distinct rows of data and how often each occurs"""
+    return np.unique(np.asarray(data), axis=0, return_counts=True)
+
+
+def aggregate_counts(levels, counts, n_bins=n_bins, n_shifts=n_shifts):
+    """returns the joint histogram of data from its distinct rows and their counts,
+    the same as joint_counts of the binned data"""
+    codes = bin_codes(levels, n_bins, n_shifts)
+    dims = codes.shape[-1]
+    flat = np.ravel_multi_index(tuple(codes.reshape(-1, dims).T), (n_bins,) * dims)
+    weights = np.tile(counts, codes.shape[0]).astype(float)
+    joint = np.bincount(flat, weights=weights, minlength=n_bins**dims)
+    return joint.reshape((n_bins,) * dims)
+
+
+# INFORMATION MEASURES
+# Each measure takes a stack of joint tables, shape (batch, target, sources...),
+# such as the bootstrap replicates of a cell's histogram (see
+# pid.bootstrap_pid_cell). A single table is decomposed as a batch of one.
+
+
+def marginal(p, sources):
+    """returns batch x target x sources tables, summing out all other source axes"""
+    keep = [1] + [axis + 1 for axis in sorted(sources)]
+    drop = tuple(axis for axis in range(1, p.ndim) if axis not in keep)
+    p_ts = p.sum(axis=drop) if drop else p
+    return p_ts.reshape(p_ts.shape[0], p_ts.shape[1], -1)
+
+
+def specific_info(p, sources):
+    """specific information about each target state in a set of source axes,
+    shape (batch, target)"""
+    p_ts = marginal(p, sources)
+    p_t = p_ts.sum(2, keepdims=True)
+    p_s = p_ts.sum(1, keepdims=True)
+    terms = np.zeros_like(p_ts)
+    nz = p_ts > 0
+    terms[nz] = p_ts[nz] * np.log2(p_ts[nz] / (p_t * p_s)[nz])
+    p_t = p_t[:, :, 0]
+    si = np.zeros_like(p_t)
+    np.divide(terms.sum(2), p_t, out=si, where=p_t > 0)
+    return si
+
+
+def redundant_info(p, source_sets):
+    """Williams-Beer I_min redundancy of the target across sets of source axes,
+    for each table of the batch"""
+    p_t = p.reshape(p.shape[0], p.shape[1], -1).sum(2)
+    si = np.stack([specific_info(p, sources) for sources in source_sets])
+    return np.sum(p_t * si.min(0), axis=1)
+
+
+def mutual_info(p, sources):
+    """mutual information between the target and a set of source axes, for each
+    table of the batch"""
+    return redundant_info(p, [sources])
+
+
+def batch_pid_3d_terms(p):
+    """PID of each 3-dimensional table (target, source 1, source 2) of the batch"""
+    mi = mutual_info(p, [1, 2])
+    i1 = mutual_info(p, [1])
+    i2 = mutual_info(p, [2])
+    r = redundant_info(p, [[1], [2]])
+    s = mi - i1 - i2 + r
+    return mi, r, s, i1 - r, i2 - r
+
+
+def batch_pid_4d_terms(p):
+    """PID of each 4-dimensional table (target, sources 1, 2 and 3) of the batch"""
+    mi = mutual_info(p, [1, 2, 3])
+    mi_12 = mutual_info(p, [1, 2])
+    mi_13 = mutual_info(p, [1, 3])
+    mi_23 = mutual_info(p, [2, 3])
+    u1 = mutual_info(p, [1]) - redundant_info(p, [[1], [2, 3]])
+    u2 = mutual_info(p, [2]) - redundant_info(p, [[2], [1, 3]])
+    u3 = mutual_info(p, [3]) - redundant_info(p, [[3], [1, 2]])
+    r = redundant_info(p, [[1], [2], [3]])
+    # synergy from the redundancy lattice (Williams & Beer 2010, supp. fig. 4)
+    r_12_13 = redundant_info(p, [[1, 2], [1, 3]])
+    r_12_23 = redundant_info(p, [[1, 2], [2, 3]])
+    r_13_23 = redundant_info(p, [[1, 3], [2, 3]])
+    r_12_13_23 = redundant_info(p, [[1, 2], [1, 3], [2, 3]])
+    s = mi - (mi_12 + mi_13 + mi_23 - r_12_13 - r_12_23 - r_13_23 + r_12_13_23)
+    return mi, u1, u2, u3, r, s
+
+
+def pid_3d_terms(p):
+    """PID of a 3-dimensional table (target, source 1, source 2)"""
+    return tuple(term[0] for term in batch_pid_3d_terms(p[None]))
+
+
+def pid_4d_terms(p):
+    """PID of a 4-dimensional table (target, sources 1, 2 and 3)"""
+    return tuple(term[0] for term in batch_pid_4d_terms(p[None]))
+
+
+# G STATISTICS
+# The smoothed MI above averages the shifted binnings, which is not the estimator
+# a chi-square null is for. The G test uses the plug-in MI of the unshifted
+# binning alone, G = 2 N ln(2) MI (in bits). Its chi-square limit, with
+# (target bins - 1)(source bins - 1) degrees of freedom, needs far more samples
+# than bins, which the joint bins of several sources are not: there G has a
+# smaller mean and a much smaller variance than that limit. So the null mean and
+# variance of G are also taken over permutations of the target codes, which are
+# cheap (a histogram each, with the binning kept).
+
+
+def g_codes(data, source_sets, n_bins=n_bins):
+    """returns the target codes of the unshifted binning of data, and the joint
+    codes of each set of source axes with their number of possible values"""
+    codes = bin_codes(data, n_bins, 0)[0].astype(np.intp)
+    sources = [
+        np.ravel_multi_index(tuple(codes[:, axes].T), (n_bins,) * len(axes))
+        for axes in source_sets
+    ]
+    return codes[:, 0], sources, [n_bins ** len(axes) for axes in source_sets]
+
+
+def g_statistic(target, source, n_source, n_bins=n_bins):
+    """returns the G statistic of a target and a source code, and its chi-square
+    degrees of freedom from their occupied bins"""
+    counts = np.bincount(
+        target * n_source + source, minlength=n_bins * n_source
+    ).reshape(n_bins, n_source)
+    n_t = counts.sum(1, keepdims=True)
+    n_s = counts.sum(0, keepdims=True)
+    nz = counts > 0
+    g = 2 * np.sum(counts[nz] * np.log(counts[nz] * len(target) / (n_t * n_s)[nz]))
+    return g, (np.count_nonzero(n_t) - 1) * (np.count_nonzero(n_s) - 1)
+
+
+def g_statistics(data, source_sets, n_permutations=100, rng=None, n_bins=n_bins):
+    """returns the G statistic of the target against each set of source axes,
+    its chi-square degrees of freedom, and its mean and variance over
+    n_permutations permutations of the target"""
+    if rng is None:
+        rng = np.random.default_rng(0)  # the same null for the same data
+    target, sources, n_sources = g_codes(data, source_sets, n_bins)
+    stats, dofs = zip(
+        *[g_statistic(target, s, n, n_bins) for s, n in zip(sources, n_sources)]
+    )
+    null = np.array(
+        [
+            [g_statistic(permuted, s, n, n_bins)[0] for s, n in zip(sources, n_sources)]
+            for permuted in (rng.permutation(target) for i in range(n_permutations))
+        ]
+    ).reshape(n_permutations, len(source_sets))
+    variances = null.var(0, ddof=1) if n_permutations > 1 else np.zeros(len(stats))
+    return list(stats), list(dofs), list(null.mean(0)), list(variances)
+
+
+# SPARSE JOINT DISTRIBUTIONS
+# With many sources a dense table of n_bins ** dims cells does not fit in memory,
+# so the joint distribution is kept as its occupied cells only (at most the
+# number of rows times the shifted binnings), and every measure is computed
+# over that support. The decomposition generalises the Williams-Beer terms above
+# to any number of sources. Joint bins are compared as rows of codes, as a flat
+# index of n_bins ** dims bins overflows beyond 18 or so columns.
+
+
+def sparse_joint_distribution(data, n_bins=n_bins, n_shifts=n_shifts):
+    """returns the occupied joint bins of data, shape (cells, dims), and their
+    probabilities, with the target on axis 0"""
+    codes = bin_codes(data, n_bins, n_shifts)
+    rows = codes.reshape(-1, codes.shape[-1])
+    cells, counts = np.unique(rows, axis=0, return_counts=True)  # no flat index
+    return cells, counts / counts.sum()
+
+
+def sparse_labels(cells, axes):
+    """labels each occupied cell by its joint bin on the given axes"""
+    return np.unique(cells[:, axes], axis=0, return_inverse=True)[1].ravel()
+
+
+def sparse_specific_info(cells, p, sources):
+    """specific information about each target state in a set of source axes"""
+    t = sparse_labels(cells, [0])
+    s = sparse_labels(cells, sorted(sources))
+    ts = sparse_labels(cells, [0] + sorted(sources))
+    p_t = np.bincount(t, weights=p)
+    p_s = np.bincount(s, weights=p)
+    p_ts = np.bincount(ts, weights=p)
+    first = np.unique(ts, return_index=True)[1]  # a cell of each (target, sources)
+    terms = p_ts * np.log2(p_ts / (p_t[t[first]] * p_s[s[first]]))
+    return np.bincount(t[first], weights=terms, minlength=len(p_t)) / p_t
+
+
+def sparse_pid_terms(cells, p):
+    """PID of a sparse joint distribution (target, sources 1, ..., n)
+
+    returns mutual information, the unique information of each source, the
+    redundancy and the synergy. For 2 and 3 sources these are the terms of
+    pid_3d_terms and pid_4d_terms.
+    """
+    sources = list(range(1, cells.shape[1]))
+    if len(sources) < 2:
+        raise ValueError("Invalid sources provided: at least 2 are needed")
+    p_t = np.bincount(sparse_labels(cells, [0]), weights=p)
+    si = {}
+
+    def i_min(source_sets):
+        """Williams-Beer I_min redundancy across sets of source axes"""
+        for sources_set in source_sets:
+            if tuple(sources_set) not in si:
+                si[tuple(sources_set)] = sparse_specific_info(cells, p, sources_set)
+        return np.sum(p_t * np.min([si[tuple(s)] for s in source_sets], axis=0))
+
+    mi = i_min([sources])
+    uniques = [
+        i_min([[i]]) - i_min([[i], [j for j in sources if j != i]]) for i in sources
+    ]
+    r = i_min([[i] for i in sources])
+    # synergy: mutual information less the union of all (n - 1)-source sets,
+    # by inclusion-exclusion over the redundancy lattice
+    top = [[j for j in sources if j != i] for i in sources]
+    union = 0
+    for size in range(1, len(top) + 1):
+        for subset in itertools.combinations(top, size):
+            union += (-1) ** (size + 1) * i_min(list(subset))
+    return (mi,) + tuple(uniques) + (r, mi - union)
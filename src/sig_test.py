@@ -7,7 +7,9 @@ import os
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from scipy.stats import mannwhitneyu
+from scipy.stats import chi2, norm
+
+from src import instrument, pid_engine
 
 from src.util import (
     surrogates_dir,
@@ -15,43 +17,356 @@ from src.util import (
     condition_cols,
     plot_pid_cols,
     pid_value_cols,
+    mi_cols,
+    mi_source_axes,
+    k_pid_value_cols,
+    full_condition_cols,
     phasic_names,
     norm_denominators,
+    pid_cols_dict,
+    spiking_files_dict,
+    load_combined_data,
 )
 
 
 def get_feather_data(dir, condition, file_name, phasic_name):
-    """gets data from a directory"""
-    condition_dir = os.path.join(dir, condition)
-    filepaths = [
-        file
-        for file in Path(condition_dir).iterdir()
-        if file.is_file() and file_name in file.name and phasic_name in file.name
-    ]
+    """gets data from a directory
+
+    Reads <file_name>_<phasic_name>, or else the one <file_name>_*_<phasic_name>
+    file (e.g. trials_surrogate_0_phasic for file_name trials_surrogate).
+    """
+    condition_dir = Path(dir, condition)
+    filepath = condition_dir / f"{file_name}_{phasic_name}"
+    filepaths = [filepath] if filepath.is_file() else []
+    if not filepaths and condition_dir.is_dir():
+        filepaths = sorted(
+            file
+            for file in condition_dir.glob(f"{file_name}_*_{phasic_name}")
+            if file.is_file()
+        )
     if filepaths == []:
-        print(
+        raise FileNotFoundError(
             f"{file_name} data does not exist for {phasic_name} {condition} condition"
         )
-        return
     elif len(filepaths) > 1:
-        print(f"Multiple files for {file_name} {phasic_name} {condition} condition")
-        return
-    else:
-        filepath = filepaths[0]
-    return pd.read_feather(filepath)
+        names = ", ".join(file.name for file in filepaths)
+        raise ValueError(
+            f"Multiple {file_name} files for {phasic_name} {condition} condition "
+            f"({names}): choose one by its name without the _{phasic_name} suffix"
+        )
+    return pd.read_feather(filepaths[0])
+
+
+def add_noise(values, groups, n_groups):
+    """Adds small amount of noise to columns that are homogeneous within a group"""
+    n_cols = values.shape[1]
+    lows = np.full((n_groups, n_cols), np.inf)
+    highs = np.full((n_groups, n_cols), -np.inf)
+    np.minimum.at(lows, groups, values)
+    np.maximum.at(highs, groups, values)
+    homogeneous = (lows == highs)[groups]
+    noise = np.random.normal(0, 0.0001, size=values.shape)
+    noisy = np.maximum(values + noise, 0)  # set all negative values to zero
+    return np.where(homogeneous, noisy, values)
+
+
+def grouped_ranks(values, groups, n_groups):
+    """ranks each column of values within each group, giving ties their mean rank.
+    returns the ranks and the tie term sum(t^3 - t) for each group and column"""
+    n, n_cols = values.shape
+    # sort every column by group, then by value within the group
+    order = np.argsort(values, axis=0, kind="stable")
+    by_group = np.argsort(groups[order], axis=0, kind="stable")
+    order = np.take_along_axis(order, by_group, axis=0)
+    sorted_values = np.take_along_axis(values, order, axis=0)
+    sorted_groups = groups[order]
+
+    # runs of tied values, numbered column by column so runs never span columns
+    new_run = np.ones((n, n_cols), dtype=bool)
+    new_run[1:] = (sorted_values[1:] != sorted_values[:-1]) | (
+        sorted_groups[1:] != sorted_groups[:-1]
+    )
+    new_run = new_run.T.ravel()
+    run_ids = np.cumsum(new_run) - 1
+    run_starts = np.flatnonzero(new_run)
+    run_sizes = np.diff(np.append(run_starts, n * n_cols)).astype(float)
+
+    # mean rank of each run within its group
+    group_starts = np.cumsum(np.bincount(groups, minlength=n_groups)) - np.bincount(
+        groups, minlength=n_groups
+    )
+    run_positions = run_starts % n + (run_sizes - 1) / 2
+    sorted_ranks = run_positions[run_ids].reshape(n_cols, n).T
+    sorted_ranks += 1 - group_starts[sorted_groups]
+    ranks = np.empty_like(sorted_ranks)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=0)
+
+    run_cells = sorted_groups.T.ravel()[run_starts] * n_cols + run_starts // n
+    ties = np.bincount(
+        run_cells, weights=run_sizes**3 - run_sizes, minlength=n_groups * n_cols
+    )
+    return ranks, ties.reshape(n_groups, n_cols)
+
+
+def mannwhitney_p(x, x_groups, y, y_groups, n_groups):
+    """two-sided Mann-Whitney U test of x against y for every group and column,
+    using the normal approximation with tie and continuity correction (as scipy)"""
+    ranks, ties = grouped_ranks(
+        np.concatenate([x, y]), np.concatenate([x_groups, y_groups]), n_groups
+    )
+    n1 = np.bincount(x_groups, minlength=n_groups)[:, None].astype(float)
+    n2 = np.bincount(y_groups, minlength=n_groups)[:, None].astype(float)
+    n = n1 + n2
+    rank_sums = np.zeros((n_groups, x.shape[1]))
+    np.add.at(rank_sums, x_groups, ranks[: len(x)])
+
+    u1 = rank_sums - n1 * (n1 + 1) / 2
+    u = np.maximum(u1, n1 * n2 - u1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sd = np.sqrt(n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1))))
+        z = (u - n1 * n2 / 2 - 0.5) / sd
+    return np.clip(2 * norm.sf(z), 0, 1)
+
+
+def projected_p_bounds(x, x_groups, y, y_groups, n_groups, scale, confidence=0.99):
+    """bounds on the Mann-Whitney p values of x against y once y has grown by scale
+    (per group) with more surrogates. returns (lower, upper) p value bounds
+
+    Each y value's placement (the fraction of x below it, ties counting half)
+    averages to U / (n1 n2). A normal confidence interval on that mean, narrowed
+    for the part of the final sample already drawn, bounds the final statistic.
+    """
+    ranks, ties = grouped_ranks(
+        np.concatenate([x, y]), np.concatenate([x_groups, y_groups]), n_groups
+    )
+    y_ranks, _ = grouped_ranks(y, y_groups, n_groups)
+    n1 = np.bincount(x_groups, minlength=n_groups)[:, None].astype(float)
+    n2 = np.bincount(y_groups, minlength=n_groups)[:, None].astype(float)
+    n = n1 + n2
+    placements = (ranks[len(x) :] - y_ranks) / n1[y_groups]
+    sums = np.zeros((n_groups, y.shape[1]))
+    squares = np.zeros((n_groups, y.shape[1]))
+    np.add.at(sums, y_groups, placements)
+    np.add.at(squares, y_groups, placements**2)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = sums / n2
+        variances = np.maximum(squares - n2 * means**2, 0) / (n2 - 1)
+        scale = np.asarray(scale, dtype=float).reshape(-1, 1)
+        margin = norm.ppf(0.5 + confidence / 2) * np.sqrt(
+            variances / n2 * (1 - 1 / scale)
+        )
+        # tie correction of the final sample taken as that of the current one
+        tie_factor = 1 - ties / (n**3 - n)
+        n2 = n2 * scale
+        sd = np.sqrt(tie_factor * n1 * n2 * (n1 + n2 + 1) / 12)
+
+        def p_values(distance):
+            """p value for a distance of the mean placement from one half"""
+            return np.clip(2 * norm.sf((distance * n1 * n2 - 0.5) / sd), 0, 1)
+
+        distance = np.abs(means - 0.5)
+        lower = p_values(distance + margin)
+        upper = p_values(np.maximum(distance - margin, 0))
+    return lower, upper
+
+
+def label_groups(results, surrogates):
+    """labels results and surrogate rows with the index of their condition group.
+    returns group keys, then PID values and groups of the results and surrogates"""
+    results_grouped = results.groupby(condition_cols)
+    group_keys = results_grouped.size().index
+    results_groups = results_grouped.ngroup().to_numpy()
+    surrogate_groups = group_keys.get_indexer(
+        pd.MultiIndex.from_frame(surrogates[condition_cols])
+    )
+    in_results = surrogate_groups >= 0
+    surrogate_groups = surrogate_groups[in_results]
+    if len(np.unique(surrogate_groups)) < len(group_keys):
+        raise ValueError("Missing surrogate data for some conditions")
+
+    res_values = add_noise(
+        results[pid_value_cols].to_numpy(dtype=float), results_groups, len(group_keys)
+    )
+    surr_values = add_noise(
+        surrogates.loc[in_results, pid_value_cols].to_numpy(dtype=float),
+        surrogate_groups,
+        len(group_keys),
+    )
+    return group_keys, res_values, results_groups, surr_values, surrogate_groups
+
+
+def undecided_groups(results, surrogates, n_surrogates, p_value=0.05, confidence=0.99):
+    """returns the conditions whose significance at p_value could still change
+
+    A condition is decided once, for every PID column computed for its
+    k_condition (see util.k_pid_value_cols), the bounds on the p value it would
+    reach with n_surrogates surrogates (see projected_p_bounds) are on the same
+    side of p_value. The other columns are zero, so their p values are noise.
+    """
+    group_keys, res_values, res_groups, surr_values, surr_groups = label_groups(
+        results, surrogates
+    )
+    n_groups = len(group_keys)
+    n_done = (
+        surrogates.groupby(condition_cols)["random_seed"]
+        .nunique()
+        .reindex(group_keys)
+        .to_numpy()
+    )
+    lower, upper = projected_p_bounds(
+        res_values,
+        res_groups,
+        surr_values,
+        surr_groups,
+        n_groups,
+        n_surrogates / n_done,
+        confidence,
+    )
+    k_conditions = group_keys.get_level_values("k_condition")
+    computed = np.array(
+        [
+            [col in k_pid_value_cols.get(k, pid_value_cols) for col in pid_value_cols]
+            for k in k_conditions
+        ]
+    )
+    undecided = np.any((lower < p_value) & (upper >= p_value) & computed, axis=1)
+    return set(tuple(float(v) for v in key) for key in group_keys[undecided])
+
+
+# ANALYTIC MI TEST
+# Under independence of target and sources, the G statistic 2 N ln(2) MI (the
+# plug-in MI in bits of one binning of N samples) is asymptotically chi-square, so
+# the MI columns can be tested without surrogate PIDs. The statistics come from
+# the unshifted binning of each cell (see pid.cell_mi_null), not from the smoothed
+# MI of the results. The joint bins of the sources are too sparse for the
+# textbook degrees of freedom, so the chi-square is scaled to match the mean and
+# variance of G over permutations of the target instead.
+
+
+def mi_statistics(results, mi_null):
+    """returns cells of results with the G statistic of each MI column, and its
+    degrees of freedom and null mean and variance (as col + '_dof', '_null_mean'
+    and '_null_var'), all 0 for MI columns not computed for the cell's
+    k_condition"""
+    g_cols = [col + "_g" for col in mi_cols]
+    null_cols = [
+        col + suffix
+        for suffix in ["_dof", "_null_mean", "_null_var"]
+        for col in mi_cols
+    ]
+    if not set(g_cols + null_cols) <= set(mi_null.columns):
+        raise ValueError(
+            "MI null data has no G statistics: rerun generate_pid_results with "
+            "mi_null=True"
+        )
+    cells = results[full_condition_cols].merge(mi_null, on=full_condition_cols)
+    if len(cells) < len(results):
+        raise ValueError("Missing MI null data for some cells")
+    computed = np.array(
+        [
+            [col in k_pid_value_cols.get(k, pid_value_cols) for col in mi_cols]
+            for k in cells["k_condition"]
+        ]
+    ).reshape(-1, len(mi_cols))
+    cells[mi_cols] = np.where(computed, cells[g_cols].to_numpy(), 0)
+    cells[null_cols] = np.where(np.tile(computed, 3), cells[null_cols].to_numpy(), 0)
+    return cells[full_condition_cols + mi_cols + null_cols]
+
+
+def chi2_p(stats, means, variances):
+    """p values of statistics under a chi-square scaled to the given null mean and
+    variance, taken as 1 where the null has no variance"""
+    stats, means, variances = np.broadcast_arrays(stats, means, variances)
+    valid = (variances > 0) & (means > 0)
+    scales = np.where(valid, variances / np.where(valid, 2 * means, 1), 1)
+    dofs = np.where(valid, 2 * means**2 / np.where(valid, variances, 1), 1)
+    return np.where(valid, chi2.sf(stats / scales, dofs), 1.0)
+
+
+def analytic_p_values(results, mi_null):
+    """p values of the MI columns of each condition from the chi-square null
+
+    Statistics and null means and variances are summed over trials groups; the
+    other PID columns have no analytic null and are left as NaN.
+    """
+    sums = mi_statistics(results, mi_null).groupby(condition_cols).sum()
+    p_values = pd.DataFrame(np.nan, index=sums.index, columns=pid_value_cols)
+    p_values[mi_cols] = chi2_p(
+        sums[mi_cols].to_numpy(),
+        sums[[col + "_null_mean" for col in mi_cols]].to_numpy(),
+        sums[[col + "_null_var" for col in mi_cols]].to_numpy(),
+    )
+    return p_values.reset_index()[plot_pid_cols].astype(float)
 
 
-def add_noise(df_in, col):
-    """Adds small amount of noise to homogeneous data"""
-    df = df_in.copy()
-    noise = np.random.normal(0, 0.0001, size=df[col].shape)
-    df[col] = df[col] + noise
-    df.loc[df[col] < 0, col] = 0  # set all negative values to zero
-    return df[col]
+def validate_analytic_p_values(
+    condition="Hebbian", phasic=True, n_cells=50, n_permutations=1000, seed=0
+):
+    """compares the chi-square null of the MI columns with permutations
 
+    For a random subset of n_cells cells of the spiking data, the target is
+    permuted within the cell n_permutations times (independently of the
+    permutations of the stored null) and the G statistics are recomputed.
+    Returns each MI column's statistic, textbook degrees of freedom, analytic p
+    value, permutation p value (from the fraction of permutations with at least
+    the observed statistic) and the ratio of the mean permuted statistic to the
+    null mean of the analytic test (1 when it is calibrated). MI columns that
+    are not computed for a cell's k_condition are left out.
+    """
+    suffix = "_ph" if phasic else "_t"
+    cols = [name + suffix for name in pid_cols_dict["4D"]]
+    df, index = load_combined_data(spiking_files_dict[condition], return_index=True)
+    block = df[cols].to_numpy()
+    rng = np.random.default_rng(seed)
+    cells = sorted(index)
+    subset = rng.choice(len(cells), min(n_cells, len(cells)), replace=False)
+    source_sets = [mi_source_axes[col] for col in mi_cols]
 
-def generate_p_values(condition="Hebbian", phasic=True):
-    """compares surrogate and results data using statistical test"""
+    rows = []
+    for cell in [cells[i] for i in np.sort(subset)]:
+        data = block[slice(*index[cell])]
+        stats, dofs, means, variances = pid_engine.g_statistics(data, source_sets)
+        target, sources, n_sources = pid_engine.g_codes(data, source_sets)
+        null = np.array(
+            [
+                [
+                    pid_engine.g_statistic(permuted, source, n_source)[0]
+                    for source, n_source in zip(sources, n_sources)
+                ]
+                for permuted in (rng.permutation(target) for i in range(n_permutations))
+            ]
+        )
+        for j, col in enumerate(mi_cols):
+            if col not in k_pid_value_cols.get(cell[1], pid_value_cols):
+                continue
+            rows.append(
+                list(cell)
+                + [col, stats[j], dofs[j]]
+                + [float(chi2_p(stats[j], means[j], variances[j]))]
+                + [(np.sum(null[:, j] >= stats[j]) + 1) / (n_permutations + 1)]
+                + [np.mean(null[:, j]) / means[j] if means[j] else np.nan]
+            )
+    table_cols = ["mi_col", "statistic", "dof", "analytic_p", "permutation_p"]
+    return pd.DataFrame(rows, columns=full_condition_cols + table_cols + ["null_ratio"])
+
+
+@instrument.traced("generate_p_values")
+def generate_p_values(
+    condition="Hebbian", phasic=True, analytic=False, surrogate_name="trials_surrogate"
+):
+    """compares surrogate and results data using statistical test
+
+    Conditions may have different numbers of surrogates (see
+    pid.adaptive_surrogates); each is tested against the surrogates it has.
+    With analytic=True, only the MI columns are tested, against their
+    chi-square null (see analytic_p_values), and no surrogates are needed, but
+    the MI null data (from generate_pid_results with mi_null=True) are.
+    surrogate_name picks the surrogate table when there are several, e.g.
+    trials_surrogate_0 from generate_surrogates or trials_surrogate_root_0 from
+    a sharded run; by default the only trials_surrogate table is used. Each call
+    is traced (see instrument.run).
+    """
     # set up
     if condition not in ["Hebbian", "Hebbian_antiHebbian", "Hebbian_scaling"]:
         raise ValueError(
@@ -60,49 +375,86 @@ def generate_p_values(condition="Hebbian", phasic=True):
         )
     phasic_name = phasic_names[phasic]
 
+    if analytic:
+        with instrument.stage("load"):
+            results = get_feather_data(
+                results_dir, condition, "trials_results", phasic_name
+            )
+            try:
+                mi_null = get_feather_data(
+                    results_dir, condition, "mi_null", phasic_name
+                )
+            except FileNotFoundError:
+                raise FileNotFoundError(
+                    f"MI null data does not exist for {phasic_name} {condition} "
+                    "condition: run generate_pid_results with mi_null=True"
+                )
+        with instrument.stage("test"):
+            return analytic_p_values(results, mi_null)
+
     # get surrogate data
-    surrogates = get_feather_data(
-        surrogates_dir, condition, "trials_surrogate", phasic_name
-    )
-    results = get_feather_data(results_dir, condition, "trials_results", phasic_name)
-
-    # Create an empty dataframe to store the p-values
-    p_values_df = pd.DataFrame(columns=plot_pid_cols)
-
-    for name, results_group in results.groupby(condition_cols):
-        surrogate_group = surrogates.groupby(condition_cols).get_group(name)
-
-        p_values = {}
-        for col in plot_pid_cols:
-            # Check if either group has all the same values
-            if col in condition_cols:
-                p_values[col] = results_group.reset_index(drop=True).loc[0, col]
-            else:
-                res_group = results_group[col]
-                surr_group = surrogate_group[col]
-                if len(set(results_group[col])) == 1:
-                    res_group = add_noise(results_group, col)
-                if len(set(surrogate_group[col])) == 1:
-                    surr_group = add_noise(surrogate_group, col)
-                stat, p = mannwhitneyu(res_group, surr_group, alternative="two-sided")
-                p_values[col] = p
-
-        p_values_df = p_values_df.append(p_values, ignore_index=True)
-    return p_values_df
-
-
-def normalise_results(df_results):
-    """normalises the PID results with respect to mutual information"""
-    df_norm = df_results.copy()
+    with instrument.stage("load"):
+        surrogates = get_feather_data(
+            surrogates_dir, condition, surrogate_name, phasic_name
+        )
+        results = get_feather_data(
+            results_dir, condition, "trials_results", phasic_name
+        )
+
+    # test all groups and PID columns at once
+    with instrument.stage("test"):
+        group_keys, res_values, res_groups, surr_values, surr_groups = label_groups(
+            results, surrogates
+        )
+        p_values = mannwhitney_p(
+            res_values, res_groups, surr_values, surr_groups, len(group_keys)
+        )
+
+    keys = group_keys.to_frame(index=False).to_numpy(dtype=float)
+    return pd.DataFrame(np.hstack([keys, p_values]), columns=plot_pid_cols)
+
+
+def normalise_results(df_results, inplace=False):
+    """normalises the PID results with respect to mutual information
+
+    Each row is divided by its k_condition's denominator (see norm_denominators),
+    picked for all rows at once by array indexing. Bias-corrected means and
+    their confidence intervals (see pid.bootstrap_cis), where present, are
+    divided by the same denominators.
+    """
+    df_norm = df_results if inplace else df_results.copy()
     norm_cols = [col + "_mean" for col in pid_value_cols]
-    for i, row in df_norm.iterrows():
-        norm_denominator = norm_denominators[row["k_condition"]]
-        df_norm.loc[i, norm_cols] = row[norm_cols].div(row[norm_denominator])
+    bc_cols = [
+        col + end
+        for end in ["_bc", "_bc_ci_low", "_bc_ci_high"]
+        for col in pid_value_cols
+        if col + end in df_norm.columns
+    ]
+    k_values = np.array(sorted(norm_denominators))
+    k_positions = [norm_cols.index(norm_denominators[k]) for k in k_values]
+    k_conditions = df_norm["k_condition"].to_numpy()
+    if not np.isin(k_conditions, k_values).all():
+        raise ValueError("Invalid k_condition provided: must be 1, 2 or 3")
+
+    values = df_norm[norm_cols].to_numpy(dtype=float)
+    positions = np.asarray(k_positions)[np.searchsorted(k_values, k_conditions)]
+    denominators = values[np.arange(len(values)), positions]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df_norm[norm_cols] = values / denominators[:, None]
+        if bc_cols:
+            bc_values = df_norm[bc_cols].to_numpy(dtype=float)
+            df_norm[bc_cols] = bc_values / denominators[:, None]
     return df_norm
 
 
-def get_norm_sig(condition="Hebbian", phasic=True):
-    """creates combined dataframe of normalised results and p values for plotting"""
+def get_norm_sig(
+    condition="Hebbian", phasic=True, analytic=False, surrogate_name="trials_surrogate"
+):
+    """creates combined dataframe of normalised results and p values for plotting
+
+    With analytic=True, p values come from generate_p_values(analytic=True).
+    surrogate_name picks the surrogate table (see generate_p_values).
+    """
     # set up
     if condition not in ["Hebbian", "Hebbian_antiHebbian", "Hebbian_scaling"]:
         raise ValueError(
@@ -111,16 +463,21 @@ def get_norm_sig(condition="Hebbian", phasic=True):
         )
     phasic_name = phasic_names[phasic]
 
-    p_values_df = generate_p_values(condition=condition, phasic=phasic)
-    p_values_df.rename(
-        columns={col: col + "_p" for col in pid_value_cols}, inplace=True
+    p_values_df = generate_p_values(
+        condition=condition,
+        phasic=phasic,
+        analytic=analytic,
+        surrogate_name=surrogate_name,
     )
+    p_values_df.columns = condition_cols + [col + "_p" for col in pid_value_cols]
 
+    # keep the mean values only, and normalise the freshly read table in place
     agg_results = get_feather_data(results_dir, condition, "final_results", phasic_name)
-    norm_results = normalise_results(agg_results)
+    std_cols = [col for col in agg_results.columns if "_std" in col]
+    agg_results.drop(columns=std_cols, inplace=True)
+    mean_results = normalise_results(agg_results, inplace=True)
 
     # combine mean values with p values
-    mean_results = norm_results.loc[:, ~norm_results.columns.str.contains("_std")]
     combined_df = mean_results.merge(
         p_values_df, how="left", on=condition_cols, suffixes=("", "_p")
     )
@@ -5,10 +5,19 @@ for reading and processing neuronal simulation data.
 
 import pandas as pd
 import numpy as np
+import hashlib
+import io
+import json
 import os
+import shutil
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
+from src import instrument
+
 # set up working directory
 working_dir = "synergy_plasticity_pid"
 current_dir = os.getcwd()
@@ -23,6 +32,7 @@ spiking_data_dir = os.path.join(working_dir, "files", "spiking_data")
 results_dir = os.path.join(working_dir, "files", "results")
 surrogates_dir = os.path.join(working_dir, "files", "surrogates")
 figures_dir = os.path.join(working_dir, "files", "figures")
+cache_dir = os.path.join(working_dir, "files", "cache")
 schemes = ["Hebbian", "Hebbian_antiHebbian", "Hebbian_scaling"]
 scheme_paths = [os.path.join(spiking_data_dir, scheme) for scheme in schemes]
 hebb_spiking_files, anti_spiking_files, scal_spiking_files = [
@@ -63,6 +73,20 @@ spiking_data_cols = [
     "in2_pathway_t",  # inhibitory pop. 2 pathway spike count (tonic)
 ]
 
+# compact dtypes for the spiking data columns (counts and condition codes)
+spiking_data_dtypes = {
+    col: np.uint16 if ("pathway_" in col or "postsynaptic" in col) else np.int32
+    for col in spiking_data_cols
+}
+spiking_data_dtypes.update(
+    {
+        "k_condition": np.uint8,
+        "learning_time": np.float32,  # float to allow the 2 -> 2.5 remap
+        "pathway": np.uint8,
+        "step_input": np.float32,
+    }
+)
+
 trials_group_cols = ["trials_group"]  # the label for the set of 10,000 trials
 
 # the columns that define each experimental condition
@@ -107,6 +131,19 @@ pid_value_cols = [
     "un_23",  # unique information (between sources 2 and 3)
 ]
 
+# mutual information cols (tested analytically by sig_test.analytic_p_values)
+mi_cols = [col for col in pid_value_cols if col.startswith("mi")]
+
+# source axes of the 4D PID columns for each MI column (the target is axis 0)
+mi_source_axes = {"mi": [1, 2, 3], "mi_13": [1, 3], "mi_12": [1, 2], "mi_23": [2, 3]}
+
+# pid value cols computed for each k_condition (the others are 0, see pid.pid_values)
+k_pid_value_cols = {
+    1: pid_value_cols,  # 4D and all three 3D decompositions
+    2: [col for col in pid_value_cols if col.endswith("_13")],  # in2 only
+    3: [col for col in pid_value_cols if col.endswith("_12")],  # in1 only
+}
+
 # phasic and tonic column names
 phasic_cols = [name + "_ph" for name in spiking_names]
 tonic_cols = [name + "_t" for name in spiking_names]
@@ -131,6 +168,9 @@ combined_cols = (
     trials_group_cols + condition_cols + step_input_cols + phasic_cols + tonic_cols
 )
 
+# dtypes of the combined data columns
+combined_dtypes = dict(spiking_data_dtypes, trials_group=np.uint16)
+
 # pid analysis dictionary
 pid_cols_dict = {
     "4D": spiking_names,
@@ -143,31 +183,165 @@ pid_cols_dict = {
 # DATA PROCESSING FUNCTIONS
 
 
+def apply_dtypes(df, dtypes):
+    """casts columns to compact dtypes, checking that integer values fit"""
+    for col in df.columns:
+        values = df[col].to_numpy()
+        cast = values.astype(dtypes[col])
+        if np.issubdtype(cast.dtype, np.integer) and not np.array_equal(cast, values):
+            raise ValueError(f"Column {col} does not fit dtype {np.dtype(dtypes[col])}")
+        df[col] = cast
+    return df
+
+
+def format_data(df, adust_time=True):
+    """adjusts learning times and casts raw spiking data to compact dtypes"""
+    if adust_time:
+        df["learning_time"] = df["learning_time"].replace(2, 2.5)
+    return apply_dtypes(df, spiking_data_dtypes)
+
+
 def read_data(filepath, adust_time=True):
     """reads spiking data from .dat format into dataframe with columns"""
     data = np.loadtxt(filepath)
     df = pd.DataFrame(data=data, columns=spiking_data_cols)
-    if adust_time:
-        df["learning_time"] = df["learning_time"].replace(2, 2.5)
+    return format_data(df, adust_time)
+
+
+def read_new_rows(filepath, offset=0, adust_time=True):
+    """reads the complete rows appended to a .dat file since a byte offset
+
+    Returns the rows and the offset after them, so a file that is still being
+    written can be read again from there; a partly written last line is left.
+    """
+    with open(filepath, "rb") as f:
+        f.seek(offset)
+        text = f.read()
+    end = text.rfind(b"\n") + 1
+    data = np.loadtxt(io.BytesIO(text[:end]), ndmin=2) if text[:end].strip() else []
+    data = np.reshape(data, (-1, len(spiking_data_cols)))
+    df = pd.DataFrame(data=data, columns=spiking_data_cols)
+    return format_data(df, adust_time), offset + end
+
+
+def combine_data(
+    scheme_filepaths,
+    trials_per_group=10000,
+    return_index=False,
+    n_workers=1,
+    extra_cols=(),
+):
+    """combines .dat files of spiking data for a plasticity condition
+
+    If return_index is True, the group index of the combined data is also returned.
+    With n_workers > 1, the files are parsed concurrently in a process pool.
+    extra_cols keeps other columns of the spiking data too (e.g. ex_all_ph).
+    """
+    with instrument.stage("read", n_files=len(scheme_filepaths)):
+        if n_workers > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                spiking_list = list(executor.map(read_data, scheme_filepaths))
+        else:
+            spiking_list = [read_data(filepath) for filepath in scheme_filepaths]
+    with instrument.stage("combine"):
+        spiking_df = pd.concat(spiking_list)
+        # reorder and drop unnecessary cols
+        sorted_df = spiking_df.sort_values(by=condition_cols)
+        # add label to each trials group
+        sorted_df.loc[:, "trials_group"] = (
+            sorted_df.groupby(condition_cols).cumcount() // trials_per_group
+        ) + 1
+        df = sorted_df[combined_cols + list(extra_cols)].reset_index(drop=True)
+        df = apply_dtypes(df, combined_dtypes)
+    if return_index:
+        return df, group_index(df)
     return df
 
 
-def combine_data(scheme_filepaths, trials_per_group=10000):
-    """combines .dat files of spiking data for a plasticity condition"""
-    spiking_list = [read_data(filepath) for filepath in scheme_filepaths]
-    spiking_df = pd.concat(spiking_list)
-    # reorder and drop unnecessary cols
-    sorted_df = spiking_df.sort_values(by=condition_cols)
-    # add label to each trials group
-    sorted_df.loc[:, "trials_group"] = (
-        sorted_df.groupby(condition_cols).cumcount() // trials_per_group
-    ) + 1
-    df = sorted_df[combined_cols].reset_index(drop=True)
+def files_key(filepaths, *args):
+    """returns a hash of file paths, sizes and modification times (and any args)"""
+    stats = [
+        (str(filepath), os.stat(filepath).st_size, os.stat(filepath).st_mtime_ns)
+        for filepath in sorted(filepaths, key=str)
+    ]
+    return hashlib.sha1(repr((stats,) + args).encode()).hexdigest()[:16]
+
+
+def load_combined_data(
+    scheme_filepaths,
+    trials_per_group=10000,
+    return_index=False,
+    n_workers=1,
+    extra_cols=(),
+):
+    """combines .dat files as in combine_data, using a binary cache in files/cache
+
+    The combined data is stored as uncompressed (memory-mappable) feather, keyed
+    by the source files' paths, sizes and mtimes, and is rebuilt when they change.
+    Data with extra_cols is cached separately from the standard columns.
+    """
+    scheme_name = os.path.basename(
+        os.path.commonpath([str(f) for f in scheme_filepaths])
+    )
+    key = files_key(
+        scheme_filepaths, trials_per_group, repr(combined_dtypes), list(extra_cols)
+    )
+    prefix = (
+        f"combined_extra_{scheme_name}" if extra_cols else f"combined_{scheme_name}"
+    )
+    cache_path = os.path.join(cache_dir, f"{prefix}_{key}")
+    if os.path.isfile(cache_path):
+        with instrument.stage("read_cache"):
+            df = pd.read_feather(cache_path)
+    else:
+        df = combine_data(
+            scheme_filepaths,
+            trials_per_group,
+            n_workers=n_workers,
+            extra_cols=extra_cols,
+        )
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for stale_path in Path(cache_dir).glob(f"{prefix}_{'?' * len(key)}"):
+            stale_path.unlink()  # remove caches of older versions of the files
+        with instrument.stage("write_cache"):
+            df.to_feather(cache_path + ".tmp", compression="uncompressed")
+            os.replace(cache_path + ".tmp", cache_path)
+    if return_index:
+        return df, group_index(df)
     return df
 
 
-def filter_data(data, k, pw, tm, g=None):
-    """filter data on k, pathway, time"""
+def group_index(df):
+    """returns the contiguous row range of each trials group and condition
+
+    Maps (trials_group, k_condition, pathway, learning_time) to (start, stop)
+    row positions, for data sorted into groups as by combine_data.
+    """
+    if len(df) == 0:
+        return {}
+    keys = df[full_condition_cols].to_numpy()
+    starts = np.flatnonzero(np.any(keys[1:] != keys[:-1], axis=1)) + 1
+    starts = np.concatenate([[0], starts])
+    stops = np.append(starts[1:], len(df))
+    index = {
+        tuple(keys[start].tolist()): (start, stop)
+        for start, stop in zip(starts.tolist(), stops.tolist())
+    }
+    if len(index) != len(starts):
+        raise ValueError("Rows of each group must be contiguous, as in combine_data")
+    return index
+
+
+def filter_data(data, k, pw, tm, g=None, index=None):
+    """filter data on k, pathway, time
+
+    If a group index is given (see group_index), the trials group is sliced
+    directly instead of masking the data.
+    """
+    if index is not None and g:
+        start, stop = index[(g, k, pw, tm)]
+        return data.iloc[start:stop]
     output = data[data["k_condition"] == k]  # select condition k=1,2,3
     output = output[output["pathway"] == pw]  # select pathway pw=1,9
     output = output[output["learning_time"] == tm]  # select time point wt=0,1,2,5,10,20
@@ -176,22 +350,175 @@ def filter_data(data, k, pw, tm, g=None):
     return output
 
 
+# STREAMED DATA
+# For schemes larger than memory, the .dat files are read in chunks and each row is
+# appended to a spill file for its condition, labelled with its trials group as it
+# arrives. Rows keep file order within a condition, as in the (stable) sort of
+# combine_data, so the groups are the same as in the combined data.
+
+# record layout of the spill files
+spill_dtype = np.dtype([(col, combined_dtypes[col]) for col in combined_cols])
+
+
+def read_data_chunks(filepath, chunk_rows=100000, adust_time=True):
+    """yields spiking data from .dat format in dataframes of up to chunk_rows rows"""
+    reader = pd.read_csv(
+        filepath,
+        sep=r"\s+",
+        header=None,
+        names=spiking_data_cols,
+        dtype=float,
+        float_precision="round_trip",
+        chunksize=chunk_rows,
+    )
+    for df in reader:
+        yield format_data(df, adust_time)
+
+
+def spill_data(scheme_filepaths, spill_dir, trials_per_group=10000, chunk_rows=100000):
+    """writes the combined data of .dat files as one spill file per condition
+
+    Only one chunk of rows is held in memory. A manifest of the conditions and
+    their row counts is written last, marking the spill as complete.
+    """
+    counts, numbers = {}, {}
+    for filepath in scheme_filepaths:
+        for chunk in read_data_chunks(filepath, chunk_rows):
+            for key, group in chunk.groupby(condition_cols, sort=False):
+                key = tuple(float(value) for value in key)
+                number = numbers.setdefault(key, len(numbers))
+                n_rows = counts.get(key, 0)
+                records = np.empty(len(group), dtype=spill_dtype)
+                for col in combined_cols:
+                    if col != "trials_group":
+                        records[col] = group[col].to_numpy()
+                # label trials groups as cumcount() // trials_per_group would
+                row_nums = np.arange(n_rows, n_rows + len(group))
+                records["trials_group"] = row_nums // trials_per_group + 1
+                path = os.path.join(spill_dir, f"condition_{number}.bin")
+                with open(path, "ab") as f:
+                    records.tofile(f)
+                counts[key] = n_rows + len(group)
+    manifest = [list(key) + [n_rows] for key, n_rows in counts.items()]
+    with open(os.path.join(spill_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+
+def load_spilled_data(scheme_filepaths, trials_per_group=10000, chunk_rows=100000):
+    """spills .dat files as in spill_data to a folder in files/cache, returning it
+
+    The spill is keyed by the source files' paths, sizes and mtimes, as in
+    load_combined_data, and is rebuilt when they change.
+    """
+    scheme_name = os.path.basename(
+        os.path.commonpath([str(f) for f in scheme_filepaths])
+    )
+    key = files_key(scheme_filepaths, trials_per_group, repr(spill_dtype))
+    spill_dir = os.path.join(cache_dir, f"spill_{scheme_name}_{key}")
+    if not os.path.isfile(os.path.join(spill_dir, "manifest.json")):
+        for stale_dir in Path(cache_dir).glob(f"spill_{scheme_name}_{'?' * len(key)}"):
+            shutil.rmtree(stale_dir)  # older versions of the files, or unfinished
+        os.makedirs(spill_dir)
+        with instrument.stage("spill"):
+            spill_data(scheme_filepaths, spill_dir, trials_per_group, chunk_rows)
+    return spill_dir
+
+
+def iter_spilled_groups(spill_dir):
+    """yields ((trials_group, k_condition, pathway, learning_time), records) for
+    each group of spilled data, in the row order of combine_data
+
+    Only one condition's spill file is read at a time.
+    """
+    with open(os.path.join(spill_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    numbered = sorted((row[:-1], number) for number, row in enumerate(manifest))
+    for key, number in numbered:
+        path = os.path.join(spill_dir, f"condition_{number}.bin")
+        records = np.fromfile(path, dtype=spill_dtype)
+        groups = records["trials_group"]
+        starts = np.flatnonzero(np.diff(groups)) + 1
+        for group in np.split(records, starts):
+            yield (int(group["trials_group"][0]),) + tuple(key), group
+
+
 # SURROGATE ANALYSIS
 
 
-def shuffle_data(df, phasic=True, random_seed=0):
-    """shuffles data to create surrogate data set"""
+def surrogate_indices(index, n_cols, seeds, batch_size=1):
+    """yields (seed, indices) for each seed, permuting rows within every group
+
+    indices[c] is a row order for column c that shuffles it independently
+    within each trials group and condition of the group index (see group_index).
+    Permutations are built a batch of seeds at once, by argsorting random keys
+    offset by group number, and depend only on the seed (an int or a
+    np.random.SeedSequence), not the batch. Each seed of a batch holds 16 bytes
+    per row and column (keys and indices), so batches above 1 are only worth it
+    for small data.
+    """
+    ranges = sorted(index.values())
+    lengths = [stop - start for start, stop in ranges]
+    group_ids = np.repeat(np.arange(len(ranges), dtype=float), lengths)
+    seeds = list(seeds)
+    for i in range(0, len(seeds), batch_size):
+        batch = seeds[i : i + batch_size]
+        keys = np.stack(
+            [
+                np.random.default_rng(seed).random((n_cols, len(group_ids)))
+                for seed in batch
+            ]
+        )
+        indices = np.argsort(keys + group_ids, axis=-1)
+        for seed, seed_indices in zip(batch, indices):
+            yield seed, seed_indices
+
+
+def permute_columns(block, indices, cols):
+    """returns a copy of block with each of cols reordered by its row indices"""
+    permuted = block.copy()
+    for col, col_indices in zip(cols, indices):
+        permuted[:, col] = block[col_indices, col]
+    return permuted
+
+
+def shuffle_data(df, phasic=True, random_seed=0, index=None):
+    """shuffles data to create surrogate data set
+
+    Each input column is permuted within each trials group and condition. The
+    data must be sorted into groups as by combine_data (see group_index).
+    """
     shuffle_cols = phasic_input_cols
     if not phasic:
         shuffle_cols = tonic_input_cols
-    np.random.seed(random_seed)  # Set the random seed
+    if index is None:
+        index = group_index(df)
+    seed, indices = next(surrogate_indices(index, len(shuffle_cols), [random_seed]))
     shuffled_df = df.copy()
-    shuffled_df[shuffle_cols] = shuffled_df.groupby(full_condition_cols)[
-        shuffle_cols
-    ].transform(lambda x: np.random.permutation(x))
+    for col, col_indices in zip(shuffle_cols, indices):
+        shuffled_df[col] = df[col].to_numpy()[col_indices]
     return shuffled_df
 
 
+# SHARED DATA FOR WORKER PROCESSES
+
+
+@contextmanager
+def shared_array(array):
+    """saves array to a temporary .npy file for worker processes to memory-map
+
+    Yields the file path, which is removed when the context exits.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "shared.npy")
+        np.save(path, array)
+        yield path
+
+
+def attach_array(path):
+    """memory-maps a shared array read-only, without copying it"""
+    return np.load(path, mmap_mode="r")
+
+
 # PLOTTING
 
 # All dictionaries for names of columns/variables